@@ -1,14 +1,252 @@
-
 from enum import Enum
+import hashlib
+import importlib.util
+import logging
 import os
+import sys
+
+try:
+    import xxhash
+except ImportError:
+    # In requirements.txt, content_hasher() still works without it
+    xxhash = None
+    logging.warning('xxhash is not installed, hashing sources with BLAKE2b instead')
 
 BUCKET_DIR = os.environ.get('BUCKET_DIR', 'bucket')
 ORIGIN = os.environ.get('ORIGIN', 'http://localhost:8080')
 DEFAULT_MAX_CONTENT_LENGTH = os.environ.get('DEFAULT_MAX_CONTENT_LENGTH', 10*1024*1024) # 10mb default limit
 SIMULATED_LATENCY = os.environ.get('SIMULATED_LATENCY', 0.050)  # IN milliseconds (0.050 for 50 ms, 0.020 ms for 20 ms...)
 
+# Transform pipeline configuration (see imageopt_pipeline.py)
+DEFAULT_ENGINE = os.environ.get('DEFAULT_ENGINE', 'auto')   # wand, vips or auto (pick using ENGINE_WEIGHTS/FORMAT_ENGINES)
+DEFAULT_LOADER = os.environ.get('DEFAULT_LOADER', 'memory') # memory, tempfile or stream
+ENGINE_WEIGHTS = os.environ.get('ENGINE_WEIGHTS', 'vips=1') # A/B split between engines, e.g. 'vips=0.9,wand=0.1'
+FORMAT_ENGINES = os.environ.get('FORMAT_ENGINES', '')       # pin source formats to an engine, e.g. 'png=wand,jpeg=vips'
+CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 64*1024))     # read size used by the stream loader
+AIO_BACKEND = os.environ.get('AIO_BACKEND', 'thread')       # file I/O of the async front end: thread or aiofiles (see imageopt_aio.py)
+AIO_THREADS = int(os.environ.get('AIO_THREADS', 8))         # threads of the thread backend
+AIO_WRITE_BATCH = int(os.environ.get('AIO_WRITE_BATCH', 256*1024))  # streamed bytes buffered per write
+
+# Latency based routing for engine=fastest (see imageopt_routing.py)
+ROUTING_TABLE = os.environ.get('ROUTING_TABLE', 'routing-table.json')       # written by `imageopt-perftest.py calibrate`
+ROUTING_ALPHA = float(os.environ.get('ROUTING_ALPHA', 0.05))                # weight of each new proc_time sample
+ROUTING_EXPLORE = float(os.environ.get('ROUTING_EXPLORE', 0.02))            # share of requests sent to a non-fastest engine
+ROUTING_FAILURE_TTL = float(os.environ.get('ROUTING_FAILURE_TTL', 300))     # seconds a failed engine/format combination is skipped
+
+# Send the origin bytes as they are when no transform is needed (see ImageOpt.can_passthrough)
+PASSTHROUGH = os.environ.get('PASSTHROUGH', '1') == '1'
+PASSTHROUGH_QUALITY_SLACK = int(os.environ.get('PASSTHROUGH_QUALITY_SLACK', 5))   # JPEGs up to quality + slack pass through
+PASSTHROUGH_HEADER_BYTES = 128*1024                                               # read from temp files to find the JPEG tables
+
+# Optimisation profile applied by the services (see PROFILES in imageopt_pipeline.py)
+OPT_PROFILE = os.environ.get('OPT_PROFILE', 'web')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))  # share of requests also encoded without the profile to measure its savings
+
+# Disk spool for large outputs (see imageopt_spool.py), off unless SPOOL_DIR is set
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '')
+SPOOL_THRESHOLD = int(os.environ.get('SPOOL_THRESHOLD', 1024*1024))       # outputs this large (in bytes) are spooled
+SPOOL_TTL = float(os.environ.get('SPOOL_TTL', 300))                        # seconds a spooled output is reused
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 1024*1024*1024))   # oldest files are deleted past this size
+SPOOL_SWEEP_INTERVAL = float(os.environ.get('SPOOL_SWEEP_INTERVAL', 30))   # seconds between clean ups
+
+# Animated/multi-page sources (see VipsEngine.decode_pages)
+MAX_FRAMES = int(os.environ.get('MAX_FRAMES', 1000))                # longer animations are rejected like oversize images
+FRAME_BATCH = int(os.environ.get('FRAME_BATCH', 8))                 # frames decoded and resized together by one worker
+FRAME_WORKERS = int(os.environ.get('FRAME_WORKERS', os.cpu_count() or 1))
+
+# Shared variant cache on Redis-protocol nodes (see imageopt_cache.py), off unless nodes are given
+SHARED_CACHE_NODES = os.environ.get('SHARED_CACHE_NODES', '')              # e.g. 'cache-1:6379,cache-2:6379'
+SHARED_CACHE_LOCAL = os.environ.get('SHARED_CACHE_LOCAL', '0') == '1'       # share a node run in one of the workers (imageopt_cacheserver.py), for development
+SHARED_CACHE_LOCAL_PORT = int(os.environ.get('SHARED_CACHE_LOCAL_PORT', 6380))
+SHARED_CACHE_TTL = float(os.environ.get('SHARED_CACHE_TTL', 3600))
+SHARED_CACHE_TIMEOUT = float(os.environ.get('SHARED_CACHE_TIMEOUT', 0.05))  # seconds, a slower node counts as a miss
+SHARED_CACHE_SMALL_ITEM = int(os.environ.get('SHARED_CACHE_SMALL_ITEM', 64*1024))       # always cached up to this size
+SHARED_CACHE_MAX_ITEM = int(os.environ.get('SHARED_CACHE_MAX_ITEM', 4*1024*1024))       # never cached above this size
+SHARED_CACHE_MIN_SECONDS_PER_MB = float(os.environ.get('SHARED_CACHE_MIN_SECONDS_PER_MB', 0.05))  # render time per MB needed in between
+SHARED_CACHE_REPLICAS = int(os.environ.get('SHARED_CACHE_REPLICAS', 100))   # points per node on the hash ring
+SHARED_CACHE_RETRY = float(os.environ.get('SHARED_CACHE_RETRY', 10))        # seconds a failed node is skipped
+
+# Negative cache of failed sources (see imageopt_negcache.py), TTLs in seconds, 0 disables
+NEGATIVE_TTL_NOT_FOUND = float(os.environ.get('NEGATIVE_TTL_NOT_FOUND', 30))      # 404 from the origin
+NEGATIVE_TTL_TOO_LARGE = float(os.environ.get('NEGATIVE_TTL_TOO_LARGE', 300))     # over DEFAULT_MAX_CONTENT_LENGTH or MAX_FRAMES
+NEGATIVE_TTL_UNSUPPORTED = float(os.environ.get('NEGATIVE_TTL_UNSUPPORTED', 300)) # not an image the engines can decode
+NEGATIVE_CACHE_MAX = int(os.environ.get('NEGATIVE_CACHE_MAX', 10000))             # entries kept per process
+
+# Origin fetches (see imageopt_origin.py), limits are per origin and per process
+ORIGIN_TIMEOUT = float(os.environ.get('ORIGIN_TIMEOUT', 10))                  # seconds before a stalled fetch is abandoned
+ORIGIN_MAX_CONCURRENCY = int(os.environ.get('ORIGIN_MAX_CONCURRENCY', 64))     # fetches in flight
+ORIGIN_QUEUE_TIMEOUT = float(os.environ.get('ORIGIN_QUEUE_TIMEOUT', 1))        # seconds to wait for a free slot
+CIRCUIT_WINDOW = float(os.environ.get('CIRCUIT_WINDOW', 30))                  # seconds of fetches the breaker looks at
+CIRCUIT_MIN_REQUESTS = int(os.environ.get('CIRCUIT_MIN_REQUESTS', 20))        # fewer fetches in the window never open it
+CIRCUIT_ERROR_RATE = float(os.environ.get('CIRCUIT_ERROR_RATE', 0.5))         # opens at this share of failed fetches
+CIRCUIT_SLOW_SECONDS = float(os.environ.get('CIRCUIT_SLOW_SECONDS', 2))       # fetches slower than this count as slow
+CIRCUIT_SLOW_RATE = float(os.environ.get('CIRCUIT_SLOW_RATE', 0.5))           # opens at this share of slow fetches
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 10))      # then lets one trial fetch through
+STALE_IF_ERROR = float(os.environ.get('STALE_IF_ERROR', 3600))                # seconds past their TTL cached variants are served while the origin is unavailable
+
+# Warm-up at worker boot (see imageopt_warmup.py)
+WARMUP = os.environ.get('WARMUP', '1') == '1'
+HOT_KEYS_FILE = os.environ.get('HOT_KEYS_FILE', 'hot-keys.json')           # '' disables recording and preloading
+HOT_KEYS_MAX = int(os.environ.get('HOT_KEYS_MAX', 200))                   # most requested paths kept in the file
+HOT_KEYS_PRELOAD = int(os.environ.get('HOT_KEYS_PRELOAD', 50))            # replayed at boot, most requested first
+WARMUP_BUDGET = float(os.environ.get('WARMUP_BUDGET', 20))                 # seconds of replaying at most, keep it under gunicorn's worker timeout
+HOT_KEYS_SAVE_INTERVAL = float(os.environ.get('HOT_KEYS_SAVE_INTERVAL', 60))  # seconds between saves of each worker's counts
+
+# Fair scheduling of transforms between tenants (see imageopt_scheduler.py)
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', os.cpu_count() or 1))   # transforms running at once per process
+TENANT_HEADER = os.environ.get('TENANT_HEADER', 'X-Tenant')                        # names the tenant, else the first segment of the origin path
+TENANT_WEIGHTS = os.environ.get('TENANT_WEIGHTS', '')                              # share of the transforms, e.g. 'acme=3,free=0.5', others get 1
+TENANT_MAX_CONCURRENCY = int(os.environ.get('TENANT_MAX_CONCURRENCY', max(TRANSFORM_WORKERS - 1, 1)))  # transforms of one tenant at once
+TENANT_MPX_RATE = float(os.environ.get('TENANT_MPX_RATE', 0))                      # source megapixels per second per tenant, 0 for no limit
+TENANT_MPX_BURST = float(os.environ.get('TENANT_MPX_BURST', 500))                  # megapixels a tenant may use at once above its rate
+TENANT_QUEUE_TIMEOUT = float(os.environ.get('TENANT_QUEUE_TIMEOUT', 10))           # seconds a transform waits for its turn
+TENANT_MAX = int(os.environ.get('TENANT_MAX', 1000))                               # tenants tracked per process, the idle ones are forgotten first
+
+# Variants keyed by source content (see imageopt_content.py)
+CONTENT_INDEX_TTL = float(os.environ.get('CONTENT_INDEX_TTL', 3600))   # seconds a URL -> content hash mapping is trusted before refetching
+CONTENT_INDEX_MAX = int(os.environ.get('CONTENT_INDEX_MAX', 100000))   # URLs (and content hashes) kept per process
+
 class ImageFormat(str, Enum):
     PNG = 'png',
     JPEG = 'jpeg',
-    WEBP = 'webp'
+    WEBP = 'webp',
+    GIF = 'gif'
+
+# Formats that may hold more than one frame
+MULTIPAGE_FORMATS = (ImageFormat.GIF, ImageFormat.WEBP)
+
+# Enough leading bytes to tell every ImageFormat apart
+SNIFF_BYTES = 16
+
+def sniff_format(head: bytes) -> ImageFormat | None:
+    """
+    Detects the image format from its magic bytes.
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return ImageFormat.JPEG
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return ImageFormat.PNG
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return ImageFormat.GIF
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return ImageFormat.WEBP
+    return None
+
+# Sum of the IJG standard luminance quantization table (quality 50)
+_STD_LUMINANCE_SUM = sum([
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99
+])
+
+def estimate_jpeg_quality(data: bytes) -> int | None:
+    """
+    Estimates the quality setting a JPEG was saved with from its luminance
+    quantization table (the inverse of libjpeg's quality scaling). Only the
+    header segments are read, so `data` can be just the start of the file.
+    """
+    if not data.startswith(b'\xff\xd8'):
+        return None
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan, no tables past this point
+            return None
+
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker == 0xDB:
+            table = pos + 4
+            end = pos + 2 + length
+            while table < end:
+                precision, table_id = data[table] >> 4, data[table] & 0x0F
+                size = 128 if precision else 64
+                values = data[table + 1:table + 1 + size]
+                if precision:
+                    values = [int.from_bytes(values[i:i + 2], 'big') for i in range(0, size, 2)]
+                if table_id == 0 and len(values) == 64:
+                    scale = 100 * sum(values) / _STD_LUMINANCE_SUM
+                    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+                    return max(1, min(100, round(quality)))
+                table += 1 + size
+        pos += 2 + length
+
+    return None
+
+def format_from_filename(filename: str) -> ImageFormat | None:
+    """
+    Guesses the format from the extension, ignoring any query string or fragment.
+    Only a hint, the magic bytes decide once the image is fetched.
+    """
+    filename = filename.split('?')[0].split('#')[0]
+    if '.' not in filename:
+        return None
+    format = filename.split('.')[-1].lower()
+    format = 'jpeg' if format == 'jpg' else format
+    try:
+        return ImageFormat(format)
+    except ValueError:
+        return None
+
+def parse_mapping(spec: str) -> dict:
+    """
+    Parses 'key=value,key=value' config strings. Values that aren't numbers are
+    kept as strings.
+    """
+    parsed = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        key, val = [s.strip() for s in item.split('=', 1)]
+        try:
+            parsed[key] = float(val)
+        except ValueError:
+            parsed[key] = val
+    return parsed
+
+class _ModuleProxy(object):
+    """
+    Stands in for a submodule until its first attribute access imports it.
+    """
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        return getattr(importlib.import_module(self._name), attr)
+
+def lazy_import(name: str):
+    """
+    Returns module `name` without executing it: it's imported on the first
+    attribute access. Native libraries (libvips, ImageMagick) are then only
+    mapped into the processes that actually use them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if '.' in name and name.rpartition('.')[0] not in sys.modules:
+        # find_spec() of a submodule imports its package, and wand's loads ImageMagick
+        return _ModuleProxy(name)
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
+def content_hasher():
+    """
+    Hash object for source bytes: 128 bit xxh3 when the xxhash package is
+    installed, BLAKE2b otherwise. Only used to tell sources apart, not for security.
+    """
+    if xxhash is None:
+        return hashlib.blake2b(digest_size=16)
+    return xxhash.xxh3_128()
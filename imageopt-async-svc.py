@@ -1,54 +1,208 @@
 from fastapi import FastAPI, Response, Request
+from fastapi.responses import FileResponse, PlainTextResponse
+from contextlib import asynccontextmanager
 import os
+import time
+from typing import Tuple
 from imageopt_async import ImageOptAsync, ImageOptAsyncV2, ImageOptAsyncV3, ImageOptAsyncV4
+from common import CIRCUIT_OPEN_SECONDS, DEFAULT_ENGINE, DEFAULT_LOADER, SHARED_CACHE_LOCAL, SHARED_CACHE_LOCAL_PORT, SHARED_CACHE_NODES, SPOOL_DIR, SPOOL_THRESHOLD, TENANT_HEADER, WARMUP, sniff_format
+from imageopt_aio import get_io_backend
+from imageopt_content import ContentIndex
+from imageopt_negcache import NegativeCache
+from imageopt_origin import OriginUnavailableError
+from imageopt_scheduler import QuotaExceededError
+from imageopt_pipeline import InvalidOptionError, OriginError, set_optimizations
+from imageopt_cache import AsyncSharedCache, admit, parse_nodes
+from imageopt_cacheserver import start_local
+from imageopt_spool import Spool
+import imageopt_warmup
+import metrics
 
 ORIGIN = os.environ.get('ORIGIN', 'http://localhost:8080')
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warms the worker up before uvicorn lets it take requests.
+    """
+    start = time.monotonic()
+    if WARMUP:
+        imageopt_warmup.warm_engines()
+        await imageopt_warmup.apreload(app, '/async')
+    imageopt_warmup.mark_ready(start)
+    yield
+    if imageopt_warmup.hot_keys.path:
+        await get_io_backend().run(imageopt_warmup.hot_keys.save, imageopt_warmup.hot_keys.take())
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware('http')
+async def record_hot_keys(req: Request, call_next):
+    response = await call_next(req)
+    if response.status_code == 200 and req.url.path not in ('/metrics', '/ready') \
+            and imageopt_warmup.WARMUP_HEADER not in req.headers:
+        imageopt_warmup.hot_keys.record(f'{req.url.path}?{req.url.query}' if req.url.query else req.url.path)
+    if imageopt_warmup.hot_keys.save_due():
+        await get_io_backend().run(imageopt_warmup.hot_keys.save, imageopt_warmup.hot_keys.take())
+    return response
+
+spool = Spool(SPOOL_DIR) if SPOOL_DIR else None
+
+cache_nodes = parse_nodes(SHARED_CACHE_NODES)
+if SHARED_CACHE_LOCAL:
+    cache_nodes.append(start_local(SHARED_CACHE_LOCAL_PORT))
+shared_cache = AsyncSharedCache(cache_nodes) if cache_nodes else None
+
+negative_cache = NegativeCache()
+
+content_index = ContentIndex(shared_cache)
+
+def error_response(status: int, message: str) -> Response:
+    return PlainTextResponse(message, status_code=status)
+
+async def cached_response(opt: ImageOptAsync) -> Tuple[Response | None, Tuple[bytes, bool] | None]:
+    """
+    Looks the variant up by its key, returns (response for a fresh hit, shared cache entry).
+    """
+    if spool:
+        spooled = await spool.alookup(opt.variant_key())
+        if spooled:
+            (path, contenttype) = spooled
+            return FileResponse(path, media_type=f'image/{contenttype}'), None
+
+    cached = None
+    if shared_cache:
+        cached = await shared_cache.get(opt.variant_key())
+        if cached and cached[1]:
+            return Response(content=cached[0], media_type=f'image/{sniff_format(cached[0]).value}'), cached
+    return None, cached
+
+async def stale_response(opt: ImageOptAsync, cached: Tuple[bytes, bool] | None) -> Response | None:
+    """
+    A cached variant past its TTL, served while the origin is unavailable or failing.
+    """
+    if 'content_hash' not in opt.state:
+        content_hash = await content_index.alookup(opt.orig_img_path, stale=True)
+        if content_hash is None:
+            return None
+        opt.state['content_hash'] = content_hash
+        cached = await shared_cache.get(opt.variant_key()) if shared_cache else None
+    if spool:
+        spooled = await spool.alookup(opt.variant_key(), stale=True)
+        if spooled:
+            (path, contenttype) = spooled
+            metrics.incr('imageopt_stale_served_total', source='spool')
+            return FileResponse(path, media_type=f'image/{contenttype}')
+    if cached:
+        metrics.incr('imageopt_stale_served_total', source='shared_cache')
+        return Response(content=cached[0], media_type=f'image/{sniff_format(cached[0]).value}')
+    return None
+
+async def optimize(opt: ImageOptAsync, req: Request) -> Response:
+    failed = negative_cache.lookup(opt.orig_img_path, opt.state['engine'])
+    if failed:
+        return error_response(*failed)
 
-def set_optimizations(opt: ImageOptAsync, req: Request):
     try:
-        width = int(req.query_params['width'])
-        if width > 0:
-            opt.resize(width, 0)
-    except:
-        pass
-    opt.png2webp(True)
-    opt.quality(80)
+        set_optimizations(opt, req.query_params)
+    except InvalidOptionError as e:
+        return error_response(400, str(e))
+    if TENANT_HEADER in req.headers:
+        opt.state['tenant'] = req.headers[TENANT_HEADER]
 
-@app.get('/async-imagemagick/{img}')
-async def get_image(img: str, req: Request):
-    async with ImageOptAsync(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, req)
-        content = await opt.get_bytes()
-        contenttype = opt.ext()
+    # Variants are keyed by content, known before the fetch if the URL was seen recently
+    cached = None
+    known_hash = await content_index.alookup(opt.orig_img_path)
+    if known_hash:
+        opt.state['content_hash'] = known_hash
+        (response, cached) = await cached_response(opt)
+        if response:
+            return response
+
+    try:
+        async with opt:
+            if opt.state['content_hash'] != known_hash:
+                # New or changed content: the variant may have been rendered for another URL
+                content_index.arecord(opt.orig_img_path, opt.state['content_hash'])
+                (response, cached) = await cached_response(opt)
+                if response:
+                    metrics.incr('imageopt_content_dedup_hits_total')
+                    return response
+            content_index.restore_metadata(opt)
+            content = await opt.get_bytes()
+            contenttype = opt.ext()
+            content_index.save_metadata(opt)
+    except OriginUnavailableError as e:
+        stale = await stale_response(opt, cached)
+        if stale:
+            return stale
+        response = error_response(503, str(e))
+        response.headers['Retry-After'] = str(int(CIRCUIT_OPEN_SECONDS))
+        return response
+    except OriginError as e:
+        stale = await stale_response(opt, cached) if e.stale_ok() else None
+        if stale:
+            return stale
+        return error_response(e.gateway_status(), str(e))
+    except QuotaExceededError as e:
+        response = error_response(429, str(e))
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    except Exception as e:
+        status = negative_cache.record(opt.orig_img_path, e)
+        if status is None:
+            raise
+        return error_response(status, str(e))
+
+    if shared_cache and admit(len(content), opt.render_seconds()):
+        shared_cache.set_in_background(opt.variant_key(), content)
+
+    if spool and len(content) >= SPOOL_THRESHOLD:
+        path = await spool.astore(opt.variant_key(), content, contenttype)
+        return FileResponse(path, media_type=f'image/{contenttype}')
 
     return Response(content=content, media_type=f'image/{contenttype}')
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    return metrics.render()
+
+@app.get('/ready', response_class=PlainTextResponse)
+async def get_ready():
+    if not imageopt_warmup.ready:
+        return PlainTextResponse('warming up', status_code=503)
+    return 'ready'
+
+@app.get('/async/{img:path}')
+async def get_image_pipeline(img: str, req: Request):
+    """
+    Engine and loader come from the `engine`/`loader` query params, falling back to
+    DEFAULT_ENGINE/DEFAULT_LOADER (see common.py).
+    """
+    try:
+        opt = ImageOptAsync(
+            f'{ORIGIN}/{img}',
+            engine=req.query_params.get('engine', DEFAULT_ENGINE),
+            loader=req.query_params.get('loader', DEFAULT_LOADER))
+    except InvalidOptionError as e:
+        return error_response(400, str(e))
+    return await optimize(opt, req)
+
+@app.get('/async-imagemagick/{img}')
+async def get_image(img: str, req: Request):
+    return await optimize(ImageOptAsync(f'{ORIGIN}/{img}'), req)
+
 @app.get('/async-imagemagick-notemp/{img}')
 async def get_image_v2(img: str, req: Request):
-    async with ImageOptAsyncV2(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, req)
-        content = await opt.get_bytes()
-        contenttype = opt.ext()
-        
-    return Response(content=content, media_type=f'image/{contenttype}')
+    return await optimize(ImageOptAsyncV2(f'{ORIGIN}/{img}'), req)
 
 @app.get('/async-libvips-notemp/{img}')
 async def get_image_v3(img: str, req: Request):
-    async with ImageOptAsyncV3(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, req)
-        content = await opt.get_bytes()
-        contenttype = opt.ext()
+    return await optimize(ImageOptAsyncV3(f'{ORIGIN}/{img}'), req)
 
 @app.get('/async-libvips/{img}')
 async def get_image_v4(img: str, req: Request):
-    async with ImageOptAsyncV4(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, req)
-        content = await opt.get_bytes()
-        contenttype = opt.ext()
-        
-    return Response(content=content, media_type=f'image/{contenttype}')
+    return await optimize(ImageOptAsyncV4(f'{ORIGIN}/{img}'), req)
 
 # fastapi dev imageopt-async-svc.py
 
@@ -0,0 +1,239 @@
+"""
+Bulk offline optimiser for the ingestion path: optimises every image of a
+directory (or listed in a manifest file, paths or URLs one per line) into an
+output directory, with the same transforms as the services.
+
+    python imageopt-bulk.py bucket output --width 640 --height 480
+    python imageopt-bulk.py sources.txt output --check hash --workers 8
+
+- decoding/encoding runs in a process pool sized to the cores, reading and
+  writing files (and fetching URLs) runs on the event loop in the meantime
+- a checkpoint manifest in the output directory records every source done, so
+  an interrupted run resumes where it stopped and a rerun only processes new
+  or changed sources (size and mtime, or content hash with --check hash)
+- progress with throughput and ETA is printed every second
+
+Outputs are named like the perftest ones: `<source path>.<output format>`,
+under the output directory (URLs as `<host>/<path>.<output format>`).
+"""
+import aiohttp
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from imageopt_aio import get_io_backend
+from imageopt_pipeline import ImageOpt, check_length, set_optimizations
+
+MANIFEST_NAME = '.imageopt-manifest.jsonl'
+
+class ImageOptBytes(ImageOpt):
+    """
+    Front end for an image already in memory, no I/O.
+    """
+    engine = 'vips'
+    loader = 'memory'
+
+    def __init__(self, name: str, content: bytes, engine: str | None = None):
+        super().__init__(name, engine=engine)
+        check_length(len(content))
+        self.source.put(content)
+        self.detect_format()
+
+    def get_bytes(self) -> bytes:
+        if self.passthrough():
+            return self.passthrough_bytes(self.source.read())
+        return self.transform(self._engine_input())
+
+def optimize(name: str, content: bytes, params: dict, engine: str) -> Tuple[bytes, str, float]:
+    """
+    Runs in the pool workers. Returns (output, output format, seconds spent).
+    """
+    start = time.process_time()
+    opt = ImageOptBytes(name, content, engine=engine)
+    set_optimizations(opt, params)
+    output = opt.get_bytes()
+    return output, opt.ext(), time.process_time() - start
+
+class Manifest(object):
+    """
+    One JSON line per processed source, appended as soon as it's done; the
+    last line of a source wins. compact() rewrites it with one line each.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interrupted run
+                        continue
+                    self.entries[entry['source']] = entry
+        self.f = open(path, 'a')
+
+    def record(self, entry: dict):
+        self.entries[entry['source']] = entry
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+
+    def compact(self):
+        self.f.close()
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp, self.path)
+
+def list_sources(source: str) -> List[str]:
+    """
+    Files under a directory (relative to it), or the lines of a manifest file.
+    """
+    if os.path.isdir(source):
+        found = []
+        for root, _, files in os.walk(source):
+            for name in files:
+                if not name.startswith('.'):
+                    found.append(os.path.relpath(os.path.join(root, name), source))
+        return sorted(found)
+
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+def is_url(source: str) -> bool:
+    return source.startswith(('http://', 'https://'))
+
+class Progress(object):
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self.start = time.monotonic()
+
+    def line(self) -> str:
+        elapsed = time.monotonic() - self.start
+        finished = self.done + self.failed
+        rate = finished / elapsed if elapsed > 0 else 0
+        remaining = self.total - self.skipped - finished
+        eta = f'{remaining / rate:.0f}s' if rate > 0 else '?'
+        return (f'{finished + self.skipped}/{self.total} ({self.skipped} unchanged, {self.failed} failed) '
+                f'{rate:.1f} img/s {self.bytes_in / elapsed / 1e6 if elapsed > 0 else 0:.1f} MB/s in, ETA {eta}')
+
+    async def show(self):
+        while True:
+            await asyncio.sleep(1)
+            print(f'\r{self.line()}', end='', file=sys.stderr, flush=True)
+
+async def read_source(session: aiohttp.ClientSession, root: str, source: str) -> bytes:
+    if is_url(source):
+        async with session.get(source) as r:
+            if r.status != 200:
+                raise FileNotFoundError(f'{source}: {r.status}')
+            return await r.read()
+    return await get_io_backend().read(os.path.join(root, source))
+
+async def run(args) -> Progress:
+    root = args.source if os.path.isdir(args.source) else ''
+    sources = list_sources(args.source)
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(os.path.join(args.output, MANIFEST_NAME))
+
+    params = {k: v for k, v in (('width', args.width), ('height', args.height), ('fit', args.fit),
+                                ('crop', args.crop), ('profile', args.profile)) if v is not None}
+    options_key = json.dumps({'params': params, 'engine': args.engine}, sort_keys=True)
+
+    progress = Progress(len(sources))
+    reporter = asyncio.create_task(progress.show())
+    loop = asyncio.get_running_loop()
+    # Enough sources read ahead to keep every worker busy, without reading them all into memory
+    slots = asyncio.Semaphore(args.workers * 2)
+
+    async def process(session: aiohttp.ClientSession, pool: ProcessPoolExecutor, source: str):
+        async with slots:
+            previous = manifest.entries.get(source)
+            unchanged = previous and previous.get('status') == 'ok' and previous.get('options') == options_key \
+                and os.path.exists(os.path.join(args.output, previous['output']))
+            entry = {'source': source, 'options': options_key}
+
+            try:
+                if not is_url(source):
+                    stat = await get_io_backend().stat(os.path.join(root, source))
+                    entry.update(size=stat.st_size, mtime=stat.st_mtime)
+                    if unchanged and args.check == 'mtime' \
+                            and (previous.get('size'), previous.get('mtime')) == (stat.st_size, stat.st_mtime):
+                        progress.skipped += 1
+                        return
+
+                content = await read_source(session, root, source)
+                entry['hash'] = hashlib.blake2b(content, digest_size=16).hexdigest()
+                if unchanged and (args.check == 'hash' or is_url(source)) and previous.get('hash') == entry['hash']:
+                    manifest.record({**previous, **entry})
+                    progress.skipped += 1
+                    return
+
+                (output, ext, cpu_seconds) = await loop.run_in_executor(
+                    pool, optimize, os.path.basename(source), content, params, args.engine)
+                # Absolute paths and URLs land under the output directory too
+                name = f'{source.split("://")[-1].lstrip("/")}.{ext}'
+                await get_io_backend().write_file(os.path.join(args.output, name), output)
+            except Exception as e:
+                logging.warning(f'{source}: {e}')
+                manifest.record({**entry, 'status': 'error', 'error': str(e)})
+                progress.failed += 1
+                return
+
+            manifest.record({**entry, 'status': 'ok', 'output': name, 'output_size': len(output)})
+            progress.done += 1
+            progress.bytes_in += len(content)
+            progress.bytes_out += len(output)
+            progress.cpu_seconds += cpu_seconds
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[process(session, pool, source) for source in sources])
+
+    reporter.cancel()
+    manifest.compact()
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description='Optimise a directory or a list of images.')
+    parser.add_argument('source', help='directory, or a file listing paths/URLs')
+    parser.add_argument('output', help='output directory, also holds the checkpoint manifest')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--engine', default='vips')
+    parser.add_argument('--check', choices=('mtime', 'hash'), default='mtime',
+                        help='how unchanged sources are recognised (URLs always use the hash)')
+    parser.add_argument('--width', type=int)
+    parser.add_argument('--height', type=int)
+    parser.add_argument('--fit')
+    parser.add_argument('--crop')
+    parser.add_argument('--profile')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    progress = asyncio.run(run(args))
+    elapsed = time.monotonic() - progress.start
+
+    print(f'\r{progress.line()}', file=sys.stderr)
+    print(f'--- {args.source} -> {args.output} ---')
+    print(f'Processed: {progress.done}, unchanged: {progress.skipped}, failed: {progress.failed}')
+    print(f'Runtime: {elapsed:.1f}s ({progress.done / elapsed if elapsed > 0 else 0:.1f} images/s)')
+    print(f'CPU time in workers: {progress.cpu_seconds:.1f}s')
+    print(f'Bytes in: {progress.bytes_in}, out: {progress.bytes_out}')
+    return 1 if progress.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
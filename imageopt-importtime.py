@@ -0,0 +1,75 @@
+"""
+Checks the import time of each entry point against its budget, using
+`python -X importtime` in a fresh interpreter, and that none of them loads an
+engine library (libvips, ImageMagick) at import: those load on first use.
+
+    python imageopt-importtime.py           # all entry points
+    python imageopt-importtime.py -v        # plus the 10 slowest imports of each
+
+Exits with 1 when a budget is exceeded or an engine library was imported.
+"""
+import os
+import re
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Entry point -> import time budget in milliseconds
+BUDGETS = {
+    'imageopt-sync-svc.py': 600,
+    'imageopt-async-svc.py': 900,
+    'imageopt-perftest.py': 900,
+    'imageopt_pipeline.py': 250,
+}
+
+# Modules only imported once an engine is used
+ENGINE_MODULES = ('pyvips.', 'wand.api', '_libvips', 'cffi')
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def measure(entry_point: str) -> List[Tuple[str, int, int]]:
+    """
+    Returns (module, self µs, cumulative µs) for the imports of the entry point.
+    """
+    code = f'import runpy; runpy.run_path({entry_point!r}, run_name="importtime")'
+    # Warm-up would load the engines on purpose
+    env = {**os.environ, 'WARMUP': '0'}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f'{entry_point} failed to import:\n{result.stderr[-2000:]}')
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2))))
+    return imports
+
+def main(verbose: bool) -> int:
+    failed = False
+    for entry_point, budget in BUDGETS.items():
+        imports = measure(entry_point)
+        # Self times add up to the total without counting nested imports twice
+        total = sum(self_us for (_, self_us, _) in imports) / 1000
+        engines = sorted({name for (name, _, _) in imports if name.startswith(ENGINE_MODULES)})
+
+        status = 'ok'
+        if total > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        if engines:
+            status = 'LOADS ENGINES'
+            failed = True
+        print(f'{entry_point:<24} {total:8.1f}ms / {budget}ms  {status}')
+
+        if engines:
+            print(f'    engine modules: {", ".join(engines[:5])}')
+        if verbose:
+            for (name, self_us, cumulative_us) in sorted(imports, key=lambda i: -i[1])[:10]:
+                print(f'    {self_us / 1000:8.1f}ms  {name}')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main('-v' in sys.argv[1:]))
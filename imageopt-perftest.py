@@ -1,15 +1,18 @@
 import asyncio
-import aiofiles
-import aiofiles.os
-import aiofiles.ospath
 import logging
 import math
 import os
+import sys
+import tempfile
 import tracemalloc
 from typing import Any, Callable, List, TypeVar
 
-from imageopt_sync import *
-from imageopt_async import *
+from imageopt_sync import ImageOptSync, ImageOptSyncV2, ImageOptSyncV3
+from imageopt_async import ImageOptAsync, ImageOptAsyncV2, ImageOptAsyncV3, ImageOptAsyncV4
+from imageopt_aio import IO_BACKENDS, get_io_backend
+from imageopt_pipeline import ENGINES
+from imageopt_routing import LatencyTable
+from common import CHUNK_SIZE, ROUTING_TABLE
 
 BUCKET_DIR = os.environ.get('BUCKET_DIR', 'bucket')
 ORIGIN = os.environ.get('ORIGIN', 'http://localhost:8080')
@@ -27,6 +30,7 @@ def flatten(thelist: List[List[T]]) -> List[T]:
 def set_optimizations(opt: ImageOptSync | ImageOptAsync):
     opt.resize(640, 480)
     opt.png2webp(True)
+    opt.gif2webp(True)
     opt.quality(80)
 
 async def perftest(images: List[str], fn: Callable[[List],List[float]], title: str):
@@ -126,8 +130,7 @@ async def perftest4(images):
         async with ImageOptAsync(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -144,8 +147,7 @@ async def perftest5(images):
         async with ImageOptAsyncV2(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -162,8 +164,7 @@ async def perftest6(images):
         async with ImageOptAsyncV3(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -180,8 +181,7 @@ async def perftest7(images):
         async with ImageOptAsyncV4(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -224,8 +224,7 @@ async def perftest9(images):
         async with ImageOptAsync(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -246,8 +245,7 @@ async def perftest10(images):
         async with ImageOptAsyncV3(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -268,8 +266,7 @@ async def perftest11(images):
         async with ImageOptAsyncV4(f'{ORIGIN}/{image}') as opt:
             set_optimizations(opt)
             
-            async with aiofiles.open(f'{outputdir}/{image}.{opt.ext()}', 'wb') as f:
-                await f.write(await opt.get_bytes())
+            await get_io_backend().write_file(f'{outputdir}/{image}.{opt.ext()}', await opt.get_bytes())
 
         return opt.state
 
@@ -284,8 +281,100 @@ async def perftest11(images):
 
     return flatten(fetch_times), flatten(proc_times)
 
+calibration_rounds = 3
+async def calibrate(images):
+    """
+    Runs every image through each engine and saves the measured proc times as the
+    latency table used by engine=fastest.
+    """
+    table = LatencyTable()
+    for _ in range(calibration_rounds):
+        for image in images:
+            for engine in ENGINES.keys():
+                try:
+                    # Fetching and sniffing fail too for a file in BUCKET_DIR that isn't an image
+                    with ImageOptSync(f'{ORIGIN}/{image}', engine=engine, loader='memory') as opt:
+                        set_optimizations(opt)
+                        (width, height) = opt.probe()
+                        # Not get_bytes(): a passed through source would record a 0s transform
+                        opt.transform(opt._engine_input())
+                except Exception as e:
+                    logging.warning(f'{engine} failed on {image}: {e}')
+                    continue
+
+                (start, end) = opt.state['proc_time']
+                table.record(engine, opt.state['informat'].value, width * height, end - start)
+
+    table.save(ROUTING_TABLE)
+    print(f'--- Routing table ({ROUTING_TABLE}) ---')
+    for key, entry in sorted(table.entries.items()):
+        print(f'{key}: {entry["mean"]:.4f}s/MP over {entry["n"]} samples')
+
+aio_requests = 2000
+aio_concurrency = 64
+async def benchmark_aio(images):
+    """
+    Runs the file I/O of async requests through each I/O backend, without
+    fetching or transforming: the source written to a temp file, read back and
+    deleted (tempfile loader), streamed to a temp file in CHUNK_SIZE chunks
+    and deleted (stream loader), and the output written.
+    """
+    contents = []
+    for image in images:
+        with open(f'{BUCKET_DIR}/{image}', 'rb') as f:
+            contents.append(f.read())
+    loop = asyncio.get_running_loop()
+
+    for (name, backend) in IO_BACKENDS.items():
+        latencies = []
+        lags = []
+        slots = asyncio.Semaphore(aio_concurrency)
+        outputdir = tempfile.mkdtemp()
+
+        async def task(i):
+            content = contents[i % len(contents)]
+            async with slots:
+                start = loop.time()
+                path = await backend.write_temp(content)
+                await backend.read(path)
+                await backend.remove(path)
+
+                async with backend.temp_writer() as f:
+                    for offset in range(0, len(content), CHUNK_SIZE):
+                        await f.write(content[offset:offset + CHUNK_SIZE])
+                await backend.remove(f.path)
+
+                await backend.write_file(f'{outputdir}/{i}', content)
+                latencies.append(loop.time() - start)
+
+        async def ticker():
+            # How late the event loop runs a 1ms timer, i.e. how long it's kept busy
+            while True:
+                expected = loop.time() + 0.001
+                await asyncio.sleep(0.001)
+                lags.append(loop.time() - expected)
+
+        ticking = asyncio.create_task(ticker())
+        run_start = loop.time()
+        await asyncio.gather(*[task(i) for i in range(aio_requests)])
+        runtime = loop.time() - run_start
+        ticking.cancel()
+
+        for i in range(aio_requests):
+            os.unlink(f'{outputdir}/{i}')
+        os.rmdir(outputdir)
+
+        latencies.sort()
+        lags.sort()
+        print(f'--- File I/O with the {name} backend ---')
+        print(f'Number of requests: {aio_requests}, {aio_concurrency} at a time')
+        print(f'Runtime: {runtime}')
+        print(f'Requests/s: {aio_requests / runtime:.0f}')
+        print(f'Latency mean: {sum(latencies) / len(latencies) * 1000:.2f}ms, p99: {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms')
+        print(f'Event loop lag p99: {lags[int(len(lags) * 0.99)] * 1000:.2f}ms')
+
 async def main_test_basic():
-    images = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpeg', '.jpg', '.png', '.webp'))]
+    images = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpeg', '.jpg', '.png', '.webp', '.gif'))]
 
     await perftest(images, perftest1, 'SyncIO ImageMagick (wand) with temp file')
     await perftest(images, perftest1, 'SyncIO ImageMagick (wand) In-memory')
@@ -296,7 +385,7 @@ async def main_test_basic():
     #await perftest(images, perftest7, 'AsyncIO libvips (pyvips) with temp file')
 
 async def main_test_bulk():
-    images = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpeg', '.jpg', '.png', '.webp'))]
+    images = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpeg', '.jpg', '.png', '.webp', '.gif'))]
 
     await perftest(images, perftest8, 'Bulk SyncIO ImageMagick (wand) with temp file')
     await perftest(images, perftest9, 'Bulk AsyncIO ImageMagick (wand) In-memory')
@@ -309,5 +398,12 @@ if __name__ == '__main__':
     
     logging.basicConfig(level=logging.WARNING)
 
-    asyncio.run(main_test_basic())
-    asyncio.run(main_test_bulk())
+    if 'calibrate' in sys.argv[1:]:
+        images = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpeg', '.jpg', '.png', '.webp', '.gif'))]
+        asyncio.run(calibrate(images))
+    elif 'aio' in sys.argv[1:]:
+        images = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpeg', '.jpg', '.png', '.webp', '.gif'))]
+        asyncio.run(benchmark_aio(images))
+    else:
+        asyncio.run(main_test_basic())
+        asyncio.run(main_test_bulk())
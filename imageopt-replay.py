@@ -0,0 +1,306 @@
+"""
+Open-loop load generator driven by real traffic, to evaluate the caches and
+concurrency limits against something closer to production than the locust
+scenarios (uniform images, a single width, closed-loop users).
+
+    # replay an access log as recorded, or scaled to a target rate
+    python imageopt-replay.py replay access.log --host http://localhost:8001 [--rate 200] [--route /async]
+
+    # fit a model (popularity, widths, arrivals) from an access log
+    python imageopt-replay.py fit access.log -o traffic-model.json
+
+    # generate traffic from a model, or from defaults over BUCKET_DIR
+    python imageopt-replay.py model [traffic-model.json] --rate 200 --duration 60
+
+Requests are sent at their scheduled time whether or not earlier ones have
+completed. Latency is reported twice: from the actual send (service time) and
+from the scheduled send (response time). The second is corrected for
+coordinated omission: when the service or the generator falls behind, the
+waiting counts against the service instead of disappearing from the stats.
+"""
+import aiohttp
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+from typing import Dict, List, Tuple
+import urllib.parse
+
+BUCKET_DIR = os.environ.get('BUCKET_DIR', 'bucket')
+
+# Combined/common log format (gunicorn, nginx) or any line with a quoted request
+LOG_TIME = re.compile(r'\[([^\]]+)\]')
+LOG_REQUEST = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+# Used by `model` without a model file
+DEFAULT_MODEL = {
+    'rate': 50,
+    'cv': 2.0,
+    'routes': {'/async': 1.0},
+    'images': [],
+    'zipf_s': 1.1,
+    'widths': {'320': 4, '640': 3, '1024': 2, '1600': 1},
+    'cold': 0.01,
+}
+
+def parse_log(path: str) -> List[Tuple[float | None, str]]:
+    """
+    Returns (seconds since the first request or None, request path) of the GETs.
+    Log timestamps have a 1s resolution, requests within a second are spread
+    evenly over it.
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            request = LOG_REQUEST.search(line)
+            if not request:
+                continue
+            stamp = LOG_TIME.search(line)
+            when = None
+            if stamp:
+                try:
+                    when = datetime.strptime(stamp.group(1), '%d/%b/%Y:%H:%M:%S %z').timestamp()
+                except ValueError:
+                    pass
+            entries.append((when, request.group(1)))
+
+    if not entries or any(when is None for (when, _) in entries):
+        return [(None, path) for (_, path) in entries]
+
+    first = entries[0][0]
+    per_second = Counter(when for (when, _) in entries)
+    seen = Counter()
+    spread = []
+    for (when, path) in entries:
+        offset = seen[when] / per_second[when]
+        seen[when] += 1
+        spread.append((when - first + offset, path))
+    return spread
+
+def scale_arrivals(entries: List[Tuple[float | None, str]], rate: float | None) -> List[Tuple[float, str]]:
+    """
+    Keeps the recorded spacing, compressed or stretched to `rate` requests per
+    second when given. Logs without timestamps need a rate and get even spacing.
+    """
+    if entries and entries[0][0] is None:
+        if not rate:
+            raise SystemExit('this log has no timestamps, pass --rate')
+        return [(i / rate, path) for i, (_, path) in enumerate(entries)]
+
+    duration = entries[-1][0] if entries else 0
+    if not rate or duration <= 0:
+        return entries
+    factor = (len(entries) / rate) / duration
+    return [(when * factor, path) for (when, path) in entries]
+
+def reroute(path: str, route: str | None) -> str:
+    """
+    Replaces the first path segment, e.g. to replay an /async log against /sync.
+    """
+    if not route:
+        return path
+    rest = path.split('/', 2)[2] if path.count('/') >= 2 else path.lstrip('/')
+    return f"{route.rstrip('/')}/{rest}"
+
+def split_path(path: str) -> Tuple[str, str, Dict[str, str]]:
+    """
+    Returns (route, image, query params) of a request path. The image keeps
+    its directories, e.g. the tenant in /async/acme/photo.jpg.
+    """
+    parsed = urllib.parse.urlsplit(path)
+    parts = parsed.path.split('/')
+    if len(parts) > 2:
+        return '/' + parts[1], '/'.join(parts[2:]), dict(urllib.parse.parse_qsl(parsed.query))
+    return '', parts[-1], dict(urllib.parse.parse_qsl(parsed.query))
+
+def fit(entries: List[Tuple[float | None, str]]) -> dict:
+    """
+    Fits the traffic model: arrival rate and burstiness (coefficient of
+    variation of the gaps), route mix, image popularity with its Zipf exponent,
+    width mix and the share of first-seen variants (cold requests).
+    """
+    routes = Counter()
+    images = Counter()
+    widths = Counter()
+    seen = set()
+    cold = 0
+    for (_, path) in entries:
+        (route, image, params) = split_path(path)
+        routes[route] += 1
+        images[image] += 1
+        widths[params.get('width', '0')] += 1
+        if path not in seen:
+            seen.add(path)
+            cold += 1
+
+    model = dict(DEFAULT_MODEL)
+    timed = [when for (when, _) in entries if when is not None]
+    if len(timed) > 1 and timed[-1] > 0:
+        gaps = [b - a for a, b in zip(timed, timed[1:])]
+        mean = sum(gaps) / len(gaps)
+        std = math.sqrt(sum((g - mean) ** 2 for g in gaps) / len(gaps))
+        model['rate'] = len(timed) / timed[-1]
+        model['cv'] = std / mean if mean > 0 else 1.0
+
+    ranked = images.most_common()
+    model['routes'] = {route: n / len(entries) for route, n in routes.items()}
+    model['images'] = [[image, n] for image, n in ranked]
+    model['zipf_s'] = zipf_exponent([n for (_, n) in ranked])
+    model['widths'] = dict(widths)
+    model['cold'] = cold / len(entries)
+    return model
+
+def zipf_exponent(counts: List[int]) -> float:
+    """
+    Least squares slope of log(count) over log(rank).
+    """
+    if len(counts) < 2:
+        return DEFAULT_MODEL['zipf_s']
+    xs = [math.log(rank) for rank in range(1, len(counts) + 1)]
+    ys = [math.log(n) for n in counts]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return max(-slope, 0.0)
+
+def generate(model: dict, rate: float | None, duration: float) -> List[Tuple[float, str]]:
+    """
+    Draws requests from the model. Gaps between arrivals are gamma distributed
+    with the model's coefficient of variation (1 is Poisson, above 1 bursty).
+    """
+    rate = rate or model['rate']
+    images = [image for (image, _) in model['images']]
+    if not images:
+        images = sorted(i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif')))
+    # Popularity follows the ranking of the log (or the bucket listing) with the fitted exponent
+    popularity = list(itertools.accumulate(1 / rank ** model['zipf_s'] for rank in range(1, len(images) + 1)))
+    (routes, route_weights) = zip(*model['routes'].items())
+    (widths, width_weights) = zip(*model['widths'].items())
+    sizes = [int(w) for w in widths if w.isdigit() and int(w) > 0] or [1024]
+
+    shape = 1 / max(model['cv'], 0.05) ** 2
+    arrivals = []
+    when = 0.0
+    while True:
+        when += random.gammavariate(shape, 1 / (rate * shape))
+        if when > duration:
+            return arrivals
+
+        image = random.choices(images, cum_weights=popularity)[0]
+        route = random.choices(routes, weights=route_weights)[0]
+        if random.random() < model['cold']:
+            # A width nobody asked for yet, i.e. a variant no cache holds
+            width = str(random.randint(min(sizes), max(sizes) + 1000))
+        else:
+            width = random.choices(widths, weights=width_weights)[0]
+        query = f'?width={width}' if width != '0' else ''
+        arrivals.append((when, f'{route}/{image}{query}'))
+
+class Results(object):
+    def __init__(self):
+        # (scheduled send, actual send, end, status)
+        self.samples: List[Tuple[float, float, float, int]] = []
+
+    def add(self, scheduled: float, sent: float, end: float, status: int):
+        self.samples.append((scheduled, sent, end, status))
+
+    def report(self, elapsed: float):
+        if not self.samples:
+            print('no requests sent')
+            return
+
+        statuses = Counter(status for (_, _, _, status) in self.samples)
+        service = sorted(end - sent for (_, sent, end, _) in self.samples)
+        response = sorted(end - scheduled for (scheduled, _, end, _) in self.samples)
+        lag = sorted(sent - scheduled for (scheduled, sent, _, _) in self.samples)
+
+        print(f'{len(self.samples)} requests in {elapsed:.1f}s ({len(self.samples) / elapsed:.1f} req/s)')
+        print('status: ' + ', '.join(f'{status}={n}' for status, n in sorted(statuses.items())))
+        print(f"{'':<26}" + ''.join(f'{"p" + str(p):>10}' for p in PERCENTILES) + f'{"max":>10}')
+        for (title, values) in (('service time (ms)', service),
+                                ('response time, CO-corrected', response),
+                                ('generator lag (ms)', lag)):
+            row = [percentile(values, p) for p in PERCENTILES] + [values[-1]]
+            print(f'{title:<26}' + ''.join(f'{v * 1000:>10.1f}' for v in row))
+
+def percentile(values: List[float], p: float) -> float:
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+async def run(arrivals: List[Tuple[float, str]], host: str, max_inflight: int, timeout: float) -> Results:
+    results = Results()
+    loop = asyncio.get_running_loop()
+
+    async def send(session: aiohttp.ClientSession, path: str, scheduled: float):
+        sent = loop.time()
+        try:
+            async with session.get(f'{host}{path}') as r:
+                await r.read()
+                status = r.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status = 0
+        results.add(scheduled, sent, loop.time(), status)
+
+    connector = aiohttp.TCPConnector(limit=max_inflight)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        start = loop.time()
+        tasks = set()
+        for (when, path) in arrivals:
+            delay = start + when - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(send(session, path, start + when))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        results.report(loop.time() - start)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Open-loop replay of recorded or modelled traffic.')
+    parser.add_argument('mode', choices=('replay', 'fit', 'model'))
+    parser.add_argument('source', nargs='?', help='access log (replay, fit) or model file (model)')
+    parser.add_argument('--host', default='http://localhost:8001')
+    parser.add_argument('--rate', type=float, help='target requests per second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of generated traffic (model)')
+    parser.add_argument('--route', help='replace the first path segment, e.g. /sync')
+    parser.add_argument('--max-inflight', type=int, default=1000, help='open connections at most')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('-o', '--output', default='traffic-model.json', help='model file written by fit')
+    args = parser.parse_args()
+
+    if args.mode == 'fit':
+        model = fit(parse_log(args.source))
+        with open(args.output, 'w') as f:
+            json.dump(model, f, indent=2)
+        print(f"wrote {args.output}: {model['rate']:.1f} req/s, cv {model['cv']:.2f}, "
+              f"zipf {model['zipf_s']:.2f}, {len(model['images'])} images, cold {model['cold']:.1%}")
+        return
+
+    if args.mode == 'replay':
+        if not args.source:
+            parser.error('replay needs an access log')
+        arrivals = scale_arrivals(parse_log(args.source), args.rate)
+    else:
+        model = DEFAULT_MODEL
+        if args.source:
+            with open(args.source) as f:
+                model = json.load(f)
+        arrivals = generate(model, args.rate, args.duration)
+
+    arrivals = [(when, reroute(path, args.route)) for (when, path) in arrivals]
+    print(f'sending {len(arrivals)} requests over {arrivals[-1][0] if arrivals else 0:.1f}s to {args.host}')
+    asyncio.run(run(arrivals, args.host, args.max_inflight, args.timeout))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,49 +1,197 @@
 from flask import *
 import os
+import time
+from typing import Tuple
 from imageopt_sync import ImageOptSync, ImageOptSyncV2, ImageOptSyncV3
+from common import CIRCUIT_OPEN_SECONDS, DEFAULT_ENGINE, DEFAULT_LOADER, SHARED_CACHE_LOCAL, SHARED_CACHE_LOCAL_PORT, SHARED_CACHE_NODES, SPOOL_DIR, SPOOL_THRESHOLD, TENANT_HEADER, WARMUP, sniff_format
+from imageopt_content import ContentIndex
+from imageopt_negcache import NegativeCache
+from imageopt_origin import OriginUnavailableError
+from imageopt_scheduler import QuotaExceededError
+from imageopt_pipeline import InvalidOptionError, OriginError, set_optimizations
+from imageopt_cache import SharedCache, admit, parse_nodes
+from imageopt_cacheserver import start_local
+from imageopt_spool import Spool
+import imageopt_warmup
+import metrics
 
 app = Flask(__name__)
 
 ORIGIN = os.environ.get('ORIGIN', 'http://localhost:8080')
 
-def set_optimizations(opt: ImageOptSync, req: Request):
+spool = Spool(SPOOL_DIR) if SPOOL_DIR else None
+
+cache_nodes = parse_nodes(SHARED_CACHE_NODES)
+if SHARED_CACHE_LOCAL:
+    cache_nodes.append(start_local(SHARED_CACHE_LOCAL_PORT))
+shared_cache = SharedCache(cache_nodes) if cache_nodes else None
+
+negative_cache = NegativeCache()
+
+content_index = ContentIndex(shared_cache)
+
+def cached_response(opt: ImageOptSync):
+    """
+    Looks the variant up by its key, returns (response for a fresh hit, shared cache entry).
+    """
+    if spool:
+        spooled = spool.lookup(opt.variant_key())
+        if spooled:
+            (path, contenttype) = spooled
+            # gunicorn serves files with os.sendfile
+            return send_file(path, mimetype=f'image/{contenttype}'), None
+
+    cached = None
+    if shared_cache:
+        cached = shared_cache.get(opt.variant_key())
+        if cached and cached[1]:
+            return (cached[0], 200, {'Content-Type': f'image/{sniff_format(cached[0]).value}'}), cached
+    return None, cached
+
+def stale_response(opt: ImageOptSync, cached: Tuple[bytes, bool] | None):
+    """
+    A cached variant past its TTL, served while the origin is unavailable or failing.
+    """
+    if 'content_hash' not in opt.state:
+        content_hash = content_index.lookup(opt.orig_img_path, stale=True)
+        if content_hash is None:
+            return None
+        opt.state['content_hash'] = content_hash
+        cached = shared_cache.get(opt.variant_key()) if shared_cache else None
+    if spool:
+        spooled = spool.lookup(opt.variant_key(), stale=True)
+        if spooled:
+            (path, contenttype) = spooled
+            metrics.incr('imageopt_stale_served_total', source='spool')
+            return send_file(path, mimetype=f'image/{contenttype}')
+    if cached:
+        metrics.incr('imageopt_stale_served_total', source='shared_cache')
+        return cached[0], 200, {'Content-Type': f'image/{sniff_format(cached[0]).value}'}
+    return None
+
+def optimize(opt: ImageOptSync):
+    failed = negative_cache.lookup(opt.orig_img_path, opt.state['engine'])
+    if failed:
+        (status, message) = failed
+        return message, status, {'Content-Type': 'text/plain'}
+
+    try:
+        set_optimizations(opt, request.args)
+    except InvalidOptionError as e:
+        return str(e), 400, {'Content-Type': 'text/plain'}
+    if TENANT_HEADER in request.headers:
+        opt.state['tenant'] = request.headers[TENANT_HEADER]
+
+    # Variants are keyed by content, known before the fetch if the URL was seen recently
+    cached = None
+    known_hash = content_index.lookup(opt.orig_img_path)
+    if known_hash:
+        opt.state['content_hash'] = known_hash
+        (response, cached) = cached_response(opt)
+        if response:
+            return response
+
     try:
-        width = int(req.args.get('width', 0))
-        if width > 0:
-            opt.resize(width, 0)
-    except:
-        pass
+        with opt:
+            if opt.state['content_hash'] != known_hash:
+                # New or changed content: the variant may have been rendered for another URL
+                content_index.record(opt.orig_img_path, opt.state['content_hash'])
+                (response, cached) = cached_response(opt)
+                if response:
+                    metrics.incr('imageopt_content_dedup_hits_total')
+                    return response
+            content_index.restore_metadata(opt)
+            content = opt.get_bytes()
+            contenttype = opt.ext()
+            content_index.save_metadata(opt)
+    except OriginUnavailableError as e:
+        stale = stale_response(opt, cached)
+        if stale:
+            return stale
+        return str(e), 503, {'Content-Type': 'text/plain', 'Retry-After': str(int(CIRCUIT_OPEN_SECONDS))}
+    except OriginError as e:
+        stale = stale_response(opt, cached) if e.stale_ok() else None
+        if stale:
+            return stale
+        return str(e), e.gateway_status(), {'Content-Type': 'text/plain'}
+    except QuotaExceededError as e:
+        return str(e), 429, {'Content-Type': 'text/plain', 'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        status = negative_cache.record(opt.orig_img_path, e)
+        if status is None:
+            raise
+        return str(e), status, {'Content-Type': 'text/plain'}
+
+    if shared_cache and admit(len(content), opt.render_seconds()):
+        shared_cache.set(opt.variant_key(), content)
 
-    opt.png2webp(True)
-    opt.quality(80)
+    if spool and len(content) >= SPOOL_THRESHOLD:
+        path = spool.store(opt.variant_key(), content, contenttype)
+        return send_file(path, mimetype=f'image/{contenttype}')
+
+    return content, 200, {'Content-Type': f'image/{contenttype}'}
+
+@app.after_request
+def record_hot_keys(response):
+    if response.status_code == 200 and request.path not in ('/metrics', '/ready') \
+            and imageopt_warmup.WARMUP_HEADER not in request.headers:
+        query = request.query_string.decode()
+        imageopt_warmup.hot_keys.record(f'{request.path}?{query}' if query else request.path)
+    if imageopt_warmup.hot_keys.save_due():
+        imageopt_warmup.hot_keys.save()
+    return response
+
+@app.route("/metrics")
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain'}
+
+@app.route("/ready")
+def get_ready():
+    if not imageopt_warmup.ready:
+        return 'warming up', 503, {'Content-Type': 'text/plain'}
+    return 'ready', 200, {'Content-Type': 'text/plain'}
+
+@app.route("/sync/<path:img>")
+def get_image_sync_pipeline(img):
+    # Engine and loader come from the `engine`/`loader` query params, falling back to
+    # DEFAULT_ENGINE/DEFAULT_LOADER (see common.py).
+    try:
+        opt = ImageOptSync(
+            f'{ORIGIN}/{img}',
+            engine=request.args.get('engine', DEFAULT_ENGINE),
+            loader=request.args.get('loader', DEFAULT_LOADER))
+    except InvalidOptionError as e:
+        return str(e), 400, {'Content-Type': 'text/plain'}
+    return optimize(opt)
 
 @app.route("/sync-imagemagick/<img>")
 def get_image_sync_imagemagick(img):
-    
-    with ImageOptSync(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, request)
-        content = opt.get_bytes()
-        contenttype = opt.ext()
-    return content, 200, {'Content-Type': f'image/{contenttype}'}
+    return optimize(ImageOptSync(f'{ORIGIN}/{img}'))
 
 @app.route("/sync-imagemagick-notemp/<img>")
 def get_image_sync_imagemagick_notemp(img):
-    with ImageOptSyncV2(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, request)
-        content = opt.get_bytes()
-        contenttype = opt.ext()
-    return content, 200, {'Content-Type': f'image/{contenttype}'}
+    return optimize(ImageOptSyncV2(f'{ORIGIN}/{img}'))
 
 @app.route("/sync-libvips-notemp/<img>")
 def get_image_sync_libvips_notemp(img):
-    with ImageOptSyncV3(f'{ORIGIN}/{img}') as opt:
-        set_optimizations(opt, request)
-        content = opt.get_bytes()
-        contenttype = opt.ext()
-    return content, 200, {'Content-Type': f'image/{contenttype}'}
+    return optimize(ImageOptSyncV3(f'{ORIGIN}/{img}'))
+
+def warm_up():
+    """
+    Runs when gunicorn loads the app in a worker, before it takes requests.
+    """
+    start = time.monotonic()
+    if WARMUP:
+        imageopt_warmup.warm_engines()
+        client = app.test_client()
+        imageopt_warmup.preload(
+            lambda path: client.get(path, headers={imageopt_warmup.WARMUP_HEADER: '1'}).status_code, '/sync')
+    imageopt_warmup.mark_ready(start)
+
+warm_up()
 
 if __name__ == '__main__':
     app.run(debug=True)
 
     # Run 
-    # gunicorn -w 4 -b 0.0.0.0:8000 imageopt-sync-svc:app
\ No newline at end of file
+    # gunicorn -w 4 -b 0.0.0.0:8000 imageopt-sync-svc:app
@@ -0,0 +1,206 @@
+"""
+File I/O for the async front end.
+
+aiofiles sends every call (open, write, close, isfile, unlink, ...) to the
+default executor separately, so a request with the tempfile loader took about
+eight thread hops. An IOBackend offers whole operations instead: writing a
+temp file, reading a file, removing one, or replacing one atomically is a
+single hop. Streamed sources go through a TempWriter, which buffers
+AIO_WRITE_BATCH bytes per hop.
+
+Backends are registered by name and picked with AIO_BACKEND:
+- thread: one hop per operation, on a pool of AIO_THREADS threads so file I/O
+  doesn't queue behind other work in the default executor
+- aiofiles: the previous per-call hops, kept as the baseline
+
+`python imageopt-perftest.py aio` compares them.
+"""
+import aiofiles
+import aiofiles.os
+import aiofiles.ospath
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import tempfile
+from typing import Callable, Dict, List, TypeVar
+
+from common import AIO_BACKEND, AIO_THREADS, AIO_WRITE_BATCH
+
+T = TypeVar('T')
+
+IO_BACKENDS: Dict[str, 'IOBackend'] = {}
+
+def register_io_backend(cls):
+    IO_BACKENDS[cls.name] = cls()
+    return cls
+
+def get_io_backend(name: str | None = None) -> 'IOBackend':
+    name = name or AIO_BACKEND
+    if name not in IO_BACKENDS:
+        raise ValueError(f"{name} is not a registered I/O backend")
+    return IO_BACKENDS[name]
+
+# Blocking operations, each run in one hop
+
+def write_temp(content: bytes, directory: str | None = None, suffix: str = '') -> str:
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=suffix, delete=False) as f:
+        f.write(content)
+        return f.name
+
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def remove_file(path: str) -> bool:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def write_file(path: str, content: bytes):
+    """
+    Writes `content` to `path`, creating its directory if needed.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def write_atomic(path: str, content: bytes):
+    """
+    Writes next to `path` then renames, so readers never see a partial file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+class TempWriter(object):
+    """
+    Writes chunks to a new temp file, `batch` bytes per hop. The file is
+    created with the first batch, and deleted again if writing fails.
+    """
+    def __init__(self, backend: 'IOBackend', batch: int = AIO_WRITE_BATCH):
+        self.backend = backend
+        self.batch = batch
+        self.path = None
+        self.f = None
+        self.pending: List[bytes] = []
+        self.pending_bytes = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        (chunks, self.pending) = (self.pending, [])
+        await self.backend.run(self._close, chunks, value is not None)
+
+    async def write(self, chunk: bytes):
+        self.pending.append(chunk)
+        self.pending_bytes += len(chunk)
+        if self.pending_bytes >= self.batch:
+            (chunks, self.pending, self.pending_bytes) = (self.pending, [], 0)
+            await self.backend.run(self._write, chunks)
+
+    def _write(self, chunks: List[bytes]):
+        if self.f is None:
+            self.f = tempfile.NamedTemporaryFile(delete=False)
+            self.path = self.f.name
+        self.f.writelines(chunks)
+
+    def _close(self, chunks: List[bytes], failed: bool):
+        try:
+            if not failed:
+                self._write(chunks)
+        finally:
+            if self.f is not None:
+                self.f.close()
+            if failed and self.path:
+                remove_file(self.path)
+                self.path = None
+
+class IOBackend(object):
+    name = None
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        Runs blocking `fn` off the event loop.
+        """
+        raise NotImplementedError()
+
+    async def write_temp(self, content: bytes, directory: str | None = None, suffix: str = '') -> str:
+        return await self.run(write_temp, content, directory, suffix)
+
+    async def read(self, path: str) -> bytes:
+        return await self.run(read_file, path)
+
+    async def remove(self, path: str) -> bool:
+        """
+        Deletes the file if it exists, returns whether it did.
+        """
+        return await self.run(remove_file, path)
+
+    async def write_file(self, path: str, content: bytes):
+        await self.run(write_file, path, content)
+
+    async def write_atomic(self, path: str, content: bytes):
+        await self.run(write_atomic, path, content)
+
+    async def stat(self, path: str) -> os.stat_result:
+        return await self.run(os.stat, path)
+
+    def temp_writer(self) -> TempWriter:
+        return TempWriter(self)
+
+@register_io_backend
+class ThreadBackend(IOBackend):
+    name = 'thread'
+
+    def __init__(self, threads: int = AIO_THREADS):
+        # Threads are only started when first needed
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='imageopt-aio')
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+@register_io_backend
+class AiofilesBackend(IOBackend):
+    """
+    aiofiles call by call, as the async front end did before.
+    """
+    name = 'aiofiles'
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def write_temp(self, content: bytes, directory: str | None = None, suffix: str = '') -> str:
+        async with aiofiles.tempfile.NamedTemporaryFile(dir=directory, suffix=suffix, delete=False) as f:
+            await f.write(content)
+            return f.name
+
+    async def read(self, path: str) -> bytes:
+        async with aiofiles.open(path, 'rb') as f:
+            return await f.read()
+
+    async def remove(self, path: str) -> bool:
+        if not await aiofiles.ospath.isfile(path):
+            return False
+        await aiofiles.os.unlink(path)
+        return True
+
+    async def write_file(self, path: str, content: bytes):
+        await aiofiles.os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        async with aiofiles.open(path, 'wb') as f:
+            await f.write(content)
+
+    async def write_atomic(self, path: str, content: bytes):
+        tmp = await self.write_temp(content, os.path.dirname(path) or '.', '.tmp')
+        await aiofiles.os.replace(tmp, path)
+
+    async def stat(self, path: str) -> os.stat_result:
+        return await aiofiles.os.stat(path)
+
+    def temp_writer(self) -> TempWriter:
+        # A hop per chunk
+        return TempWriter(self, batch=0)
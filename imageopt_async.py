@@ -1,46 +1,22 @@
-import asyncio
-import aiofiles
-import aiofiles.os
-import aiofiles.ospath
 import aiohttp
-import logging
-import os
-import pyvips
-import time
+import asyncio
 from typing import Tuple
 import urllib3
 import urllib3.util
-from wand.image import Image
-
-from common import ImageFormat
 
-ORIGIN = os.environ.get('ORIGIN', 'http://localhost:8080')
-DEFAULT_MAX_CONTENT_LENGTH = os.environ.get('DEFAULT_MAX_CONTENT_LENGTH', 10*1024*1024) # 10mb default limit
+from common import CHUNK_SIZE, ORIGIN_TIMEOUT
+from imageopt_aio import get_io_backend
+from imageopt_origin import get_guard
+from imageopt_pipeline import ImageOpt, OriginError, check_length, check_origin_status, get_engine
+from imageopt_scheduler import scheduler
 
-class ImageOptAsync(object):
-
-    def __init__(self, img: str):
-        self.orig_img_path = img
-        
-        filename = img.split('/')[-1]
-        format = filename.split('.')[-1]
-        format = 'jpeg' if format == 'jpg' else format
-
-        outformat = ImageFormat(format)
-        if outformat is None:
-            raise ValueError(f"{filename} is not a supported image")
-
-        # Transient state maintained while handling image
-        self.state = {
-            'filename': filename,
-            'tempfile': None,
-            'image_checked': False,
-            'outformat': outformat,
-            'outfile': None
-        }
-
-        # Selected image options
-        self.imageoptions = {}
+class ImageOptAsync(ImageOpt):
+    """
+    Non-blocking I/O front end for the transform pipeline.
+    Defaults to ImageMagick with a temp file.
+    """
+    engine = 'wand'
+    loader = 'tempfile'
 
     async def __aenter__(self):
         await self.load()
@@ -49,17 +25,32 @@ class ImageOptAsync(object):
     async def __aexit__(self, type, value, traceback):
         await self.close()
 
-    async def _fetchimg(self, imgurl)  -> Tuple[bytes, Tuple[float, float]] | Tuple[None, Tuple[float, float]]:
-        async with aiohttp.ClientSession() as session:
+    async def _fetchimg(self, imgurl) -> Tuple[float, float]:
+        """
+        Fetches the image into self.source and returns the time spent waiting on the origin.
+        Raises OriginUnavailableError without fetching when the origin guard rejects it,
+        and OriginError when the origin can't be reached.
+        """
+        timeout = aiohttp.ClientTimeout(total=ORIGIN_TIMEOUT)
+        async with get_guard(imgurl).afetch(), aiohttp.ClientSession(timeout=timeout) as session:
             start = asyncio.get_running_loop().time()
-            async with session.get(imgurl) as r:
-                end = asyncio.get_running_loop().time()
-                if r.status == 200:
-                    contents = await r.read()
-
-                    return contents, (start, end)
-                else:
-                    return None, (start, end)
+            try:
+                async with session.get(imgurl) as r:
+                    end = asyncio.get_running_loop().time()
+                    check_origin_status(imgurl, r.status)
+
+                    if self.source.streaming:
+                        await self.source.aput_stream(r.content.iter_chunked(CHUNK_SIZE))
+                    else:
+                        contents = await r.read()
+                        check_length(len(contents))
+                        await self.source.aput(contents)
+            except asyncio.TimeoutError as e:
+                raise OriginError(imgurl, None, f'origin timed out after {ORIGIN_TIMEOUT}s', timeout=True) from e
+            except aiohttp.ClientError as e:
+                raise OriginError(imgurl, None, f'origin unreachable: {e}') from e
+
+        return (start, end)
                 
     async def load(self):
         if self.state['image_checked']:
@@ -69,204 +60,68 @@ class ImageOptAsync(object):
         is_valid_url = url.scheme and url.host and url.path
 
         if is_valid_url:
-            async with aiofiles.tempfile.NamedTemporaryFile(delete=False) as f:
-                content, elapsed = await self._fetchimg(self.orig_img_path)
-                self.state['request_time'] = elapsed
-
-                if content is None:
-                    raise FileNotFoundError(self.orig_img_path)
-                
-                if len(content) > DEFAULT_MAX_CONTENT_LENGTH:
-                    raise BufferError(f"Content length cannot be more than {DEFAULT_MAX_CONTENT_LENGTH}mb")
-                await f.write(content)
-                
-                self.state['tempfile'] = f.name
+            try:
+                self.state['request_time'] = await self._fetchimg(self.orig_img_path)
+                self.state['content_hash'] = self.source.content_hash()
+                self.detect_format()
+            except:
+                # Raised from __enter__, so close() won't run: drop a partially written temp file now
+                await self.close()
+                raise
         else:
             raise FileNotFoundError(self.orig_img_path)
         
         self.state['image_checked'] = True
 
     async def close(self):
-        tempfile = self.state['tempfile']
-        if tempfile and await aiofiles.os.path.isfile(tempfile):
-            await aiofiles.os.unlink(tempfile)
-            logging.debug(f'deleted temp file: {tempfile}')
-
-        self.state['tempfile'] = None
+        await self.source.arelease()
         self.state['image_checked'] = False
-            
-
-    async def get_bytes(self):
-        await self.load()
-        async with aiofiles.open(self.state['tempfile'], 'rb') as f:
-            image_binary = await f.read()
-
-            start_proc = time.time()
-            img = Image(blob=image_binary)
-
-            if 'resize' in self.imageoptions.keys():
-                (width, height) = self.imageoptions['resize']
-                if height <= 0:
-                    val = f'{width}'
-                else:
-                    val = f'{width}x{height}'
-                img.transform(resize=val)
-
-            if 'quality' in self.imageoptions.keys() and img.format in ['jpg', 'jpeg']:
-                img.compression_quality = self.imageoptions['quality']
-
-            if 'webp' in self.imageoptions.keys() and self.imageoptions['webp']:
-                img.format = 'webp'
-                
-            blob = img.make_blob()
-            end_proc = time.time()
-            self.state['proc_time'] = (start_proc, end_proc)
-            return blob
-
-    def ext(self):
-        return self.state['outformat'].value
-        
-    def resize(self, width: int, height: int):
-        self.imageoptions['resize'] = (width, height)
-
-    def png2webp(self, activate: bool):
-        if activate and self.state['outformat'] == ImageFormat.PNG:
-            self.imageoptions['webp'] = True
-            self.state['outformat'] = ImageFormat.WEBP
-
-    def quality(self, quality: float):
-        if self.state['outformat'] == ImageFormat.JPEG:
-            self.imageoptions['quality'] = quality
-
-class ImageOptAsyncV2(ImageOptAsync):
-    def __init__(self, img: str):
-        super().__init__(img)
-
-    async def load(self):
-        if self.state['image_checked']:
-            return
-        
-        url = urllib3.util.parse_url(self.orig_img_path)
-        is_valid_url = url.scheme and url.host and url.path
 
-        if is_valid_url:
-            # Replace use of temp file with keeping contents in memory
-            content, elapsed = await self._fetchimg(self.orig_img_path)
-            self.state['request_time'] = elapsed
-            if content is None:
-                raise FileNotFoundError(self.orig_img_path)
-                
-            if len(content) > DEFAULT_MAX_CONTENT_LENGTH:
-                raise BufferError(f"Content length cannot be more than {DEFAULT_MAX_CONTENT_LENGTH}mb")
-            
-            self.state['tempfile'] = content
-        else:
-            raise FileNotFoundError(self.orig_img_path)
-        
-        self.state['image_checked'] = True
+    async def _aengine_input(self) -> bytes | str:
+        self.route()
+        if self.source.path and get_engine(self.state['engine']).accepts_path:
+            return self.source.path
+        return await self.source.aread()
 
-    async def close(self):
+    def _inspect(self) -> Tuple[bool, float]:
         """
-        No more temp files to delete
+        Whether the source is passed through and, if not, the engine and the
+        transform's cost. All of them read the source header, probed once.
         """
-
-        self.state['tempfile'] = None
-        self.state['image_checked'] = False
-
-    async def get_bytes(self):
-        await self.load()
-
-        start_proc = time.time()
-        img = Image(blob=self.state['tempfile'])
-
-        if 'resize' in self.imageoptions.keys():
-            (width, height) = self.imageoptions['resize']
-            if height <= 0:
-                val = f'{width}'
-            else:
-                val = f'{width}x{height}'
-            img.transform(resize=val)
-
-        if 'quality' in self.imageoptions.keys() and img.format == 'jpg':
-            img.compression_quality = self.imageoptions['webp']
-
-        if 'webp' in self.imageoptions.keys() and self.imageoptions['webp']:
-            img.format = 'webp'
-        
-        blob = img.make_blob()
-        end_proc = time.time()
-        self.state['proc_time'] = (start_proc, end_proc)
-        return blob
-    
-class ImageOptAsyncV3(ImageOptAsyncV2):
-    def __init__(self, img: str):
-        super().__init__(img)
+        if self.passthrough():
+            return True, 0.0
+        self.route()
+        return False, self.megapixels()
 
     async def get_bytes(self):
         await self.load()
-
-        start_proc = time.time()
-        outformat = ImageFormat(self.state['outformat'])
-
-        # use vips_thumbnail() and vips_thumbnail_buffer() for best resize performance
-        # https://github.com/libvips/libvips/wiki/HOWTO----Image-shrinking
-        if 'resize' in self.imageoptions.keys():
-            (width, height) = self.imageoptions['resize']
-            if height <= 0:
-                img = pyvips.Image.thumbnail_buffer(self.state['tempfile'], width)
-            else:
-                img = pyvips.Image.thumbnail_buffer(self.state['tempfile'], width, height=height)
+        if self.source.path:
+            # Reading the header of a temp file blocks, so it's one I/O backend hop
+            (passthrough, cost) = await get_io_backend().run(self._inspect)
         else:
-            img = pyvips.Image.new_from_buffer(self.state['tempfile'])
+            (passthrough, cost) = self._inspect()
+        if passthrough:
+            return self.passthrough_bytes(await self.source.aread())
+        src = await self._aengine_input()
+        # In the scheduler's threads, so the event loop keeps serving meanwhile
+        async with scheduler.aslot(self.state['tenant'], cost):
+            return await scheduler.run(self.transform, src)
 
-        if 'webp' in self.imageoptions.keys() and self.imageoptions['webp']:
-            outformat = ImageFormat.WEBP
-        
-        if outformat == ImageFormat.PNG:
-            buffer = img.pngsave_buffer()
-        elif outformat == ImageFormat.WEBP:
-            buffer = img.webpsave_buffer()
-        elif outformat == ImageFormat.JPEG:
-            if 'quality' in self.imageoptions.keys() and outformat == ImageFormat.JPEG:
-                buffer = img.jpegsave_buffer(Q=self.imageoptions['quality'])
-            else:
-                buffer = img.jpegsave_buffer()
-
-        end_proc = time.time()
-        self.state['proc_time'] = (start_proc, end_proc)
-        return buffer
+class ImageOptAsyncV2(ImageOptAsync):
+    """
+    ImageMagick, keeping the image in memory.
+    """
+    loader = 'memory'
+    
+class ImageOptAsyncV3(ImageOptAsync):
+    """
+    libvips, keeping the image in memory.
+    """
+    engine = 'vips'
+    loader = 'memory'
     
 class ImageOptAsyncV4(ImageOptAsync):
-    async def get_bytes(self):
-        await self.load()
-
-        start_proc = time.time()
-        outformat = ImageFormat(self.state['outformat'])
-
-        # use vips_thumbnail() and vips_thumbnail_buffer() for best resize performance
-        # https://github.com/libvips/libvips/wiki/HOWTO----Image-shrinking
-        if 'resize' in self.imageoptions.keys():
-            (width, height) = self.imageoptions['resize']
-            if height <= 0:
-                img = pyvips.Image.thumbnail(self.state['tempfile'], width)
-            else:
-                img = pyvips.Image.thumbnail(self.state['tempfile'], width, height=height)
-        else:
-            img = pyvips.Image.new_from_file(self.state['tempfile'])
-
-        if 'webp' in self.imageoptions.keys() and self.imageoptions['webp']:
-            outformat = ImageFormat.WEBP
-        
-        if outformat == ImageFormat.PNG:
-            buffer = img.pngsave_buffer()
-        elif outformat == ImageFormat.WEBP:
-            buffer = img.webpsave_buffer()
-        elif outformat == ImageFormat.JPEG:
-            if 'quality' in self.imageoptions.keys() and outformat == ImageFormat.JPEG:
-                buffer = img.jpegsave_buffer(Q=self.imageoptions['quality'])
-            else:
-                buffer = img.jpegsave_buffer()
-
-        end_proc = time.time()
-        self.state['proc_time'] = (start_proc, end_proc)
-        return buffer
\ No newline at end of file
+    """
+    libvips, opening the image from a temp file.
+    """
+    engine = 'vips'
@@ -0,0 +1,322 @@
+"""
+Shared variant cache on Redis-protocol nodes (Redis, KeyDB, Dragonfly or the
+stand-in in imageopt_cacheserver.py), so a variant rendered by one worker or
+pod is reused by the others.
+
+- keys are spread over the nodes with consistent hashing, so adding or
+  removing a node only moves its share of the keys
+- several keys are read/written in one round trip per node (pipelining)
+- admit() keeps large outputs that were cheap to make out of the cache, they
+  cost more to move over the network than to render again
+- a node that errors or times out is skipped for SHARED_CACHE_RETRY seconds
+  and its keys are treated as misses, so the cache never fails a request
+- entries are kept STALE_IF_ERROR seconds past SHARED_CACHE_TTL; reads return
+  (content, fresh) and stale content is only served while the origin is
+  unavailable
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from common import (
+    SHARED_CACHE_MAX_ITEM,
+    SHARED_CACHE_MIN_SECONDS_PER_MB,
+    SHARED_CACHE_REPLICAS,
+    SHARED_CACHE_RETRY,
+    SHARED_CACHE_SMALL_ITEM,
+    SHARED_CACHE_TIMEOUT,
+    SHARED_CACHE_TTL,
+    STALE_IF_ERROR
+)
+import metrics
+
+KEY_PREFIX = b'imageopt:v2:'
+# Values start with the time they were stored at
+_STORED_AT = struct.Struct('>d')
+
+class CacheError(Exception):
+    pass
+
+def encode_command(*args) -> bytes:
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+def _parse_line(line: bytes):
+    """
+    Returns (type, payload) of a reply header line.
+    """
+    if not line.endswith(b'\r\n'):
+        raise CacheError('connection closed')
+    return line[:1], line[1:-2]
+
+def read_reply(f):
+    (kind, payload) = _parse_line(f.readline())
+    if kind == b'+':
+        return payload
+    if kind == b'-':
+        raise CacheError(payload.decode())
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        length = int(payload)
+        return None if length < 0 else f.read(length + 2)[:-2]
+    if kind == b'*':
+        count = int(payload)
+        return None if count < 0 else [read_reply(f) for _ in range(count)]
+    raise CacheError(f'unexpected reply {kind!r}')
+
+async def aread_reply(reader: asyncio.StreamReader):
+    (kind, payload) = _parse_line(await reader.readline())
+    if kind == b'+':
+        return payload
+    if kind == b'-':
+        raise CacheError(payload.decode())
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        length = int(payload)
+        return None if length < 0 else (await reader.readexactly(length + 2))[:-2]
+    if kind == b'*':
+        count = int(payload)
+        return None if count < 0 else [await aread_reply(reader) for _ in range(count)]
+    raise CacheError(f'unexpected reply {kind!r}')
+
+class HashRing(object):
+    """
+    Consistent hashing with `replicas` virtual points per node.
+    """
+    def __init__(self, nodes: Iterable[str], replicas: int = SHARED_CACHE_REPLICAS):
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            for i in range(replicas):
+                point = self._hash(f'{node}#{i}'.encode())
+                self.points.append(point)
+                self.owners[point] = node
+        self.points.sort()
+
+    @staticmethod
+    def _hash(key: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+    def node_for(self, key: bytes) -> str:
+        i = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[self.points[i]]
+
+def parse_nodes(spec: str) -> List[str]:
+    return [node.strip() for node in spec.split(',') if node.strip()]
+
+def admit(size: int, saved_seconds: float) -> bool:
+    """
+    Small outputs are always cached. Larger ones only when rendering them again
+    would take longer per MB than SHARED_CACHE_MIN_SECONDS_PER_MB, and never
+    above SHARED_CACHE_MAX_ITEM.
+    """
+    if size > SHARED_CACHE_MAX_ITEM:
+        return False
+    if size <= SHARED_CACHE_SMALL_ITEM:
+        return True
+    return saved_seconds / (size / (1024*1024)) >= SHARED_CACHE_MIN_SECONDS_PER_MB
+
+class _BaseCache(object):
+    def __init__(self, nodes: List[str], ttl: float = SHARED_CACHE_TTL, timeout: float = SHARED_CACHE_TIMEOUT):
+        self.nodes = nodes
+        self.ring = HashRing(nodes)
+        self.ttl = ttl
+        self.timeout = timeout
+        # node -> time until which it is skipped
+        self.down: Dict[str, float] = {}
+
+    def _group(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        groups = {}
+        for key in keys:
+            node = self.ring.node_for(KEY_PREFIX + key.encode())
+            if self.down.get(node, 0) > time.monotonic():
+                continue
+            groups.setdefault(node, []).append(key)
+        return groups
+
+    def _mark_down(self, node: str, e: Exception):
+        logging.warning(f'shared cache node {node} failed, skipping it for {SHARED_CACHE_RETRY}s: {e}')
+        self.down[node] = time.monotonic() + SHARED_CACHE_RETRY
+        metrics.incr('imageopt_shared_cache_errors_total', node=node)
+
+    def _pack(self, content: bytes) -> bytes:
+        return _STORED_AT.pack(time.time()) + content
+
+    def _unpack(self, value: bytes) -> Tuple[bytes, bool]:
+        (stored_at,) = _STORED_AT.unpack_from(value)
+        return value[_STORED_AT.size:], time.time() - stored_at < self.ttl
+
+    def _set_command(self, key: str, content: bytes) -> Tuple:
+        return ('SET', KEY_PREFIX + key.encode(), self._pack(content), 'EX', int(self.ttl + STALE_IF_ERROR))
+
+    def _found(self, pairs: Iterable[Tuple[str, bytes | None]], requested: int) -> Dict[str, Tuple[bytes, bool]]:
+        found = {k: self._unpack(v) for k, v in pairs if v is not None}
+        fresh = sum(1 for (_, is_fresh) in found.values() if is_fresh)
+        metrics.incr('imageopt_shared_cache_hits_total', fresh)
+        metrics.incr('imageopt_shared_cache_stale_total', len(found) - fresh)
+        metrics.incr('imageopt_shared_cache_misses_total', requested - len(found))
+        return found
+
+    @staticmethod
+    def _address(node: str) -> Tuple[str, int]:
+        (host, port) = node.rsplit(':', 1)
+        return host, int(port)
+
+class SharedCache(_BaseCache):
+    """
+    Blocking client, one connection per node and thread.
+    """
+    def __init__(self, nodes: List[str], **kwargs):
+        super().__init__(nodes, **kwargs)
+        self.local = threading.local()
+
+    def _connection(self, node: str):
+        connections = self.local.__dict__.setdefault('connections', {})
+        if node not in connections:
+            sock = socket.create_connection(self._address(node), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections[node] = (sock, sock.makefile('rb'))
+        return connections[node]
+
+    def _drop(self, node: str):
+        connections = self.local.__dict__.get('connections', {})
+        if node in connections:
+            (sock, f) = connections.pop(node)
+            f.close()
+            sock.close()
+
+    def pipeline(self, node: str, commands: List[Tuple]) -> List:
+        """
+        Sends all the commands in one write and reads the replies in order.
+        """
+        try:
+            (sock, f) = self._connection(node)
+            sock.sendall(b''.join(encode_command(*c) for c in commands))
+            return [read_reply(f) for _ in commands]
+        except (OSError, CacheError) as e:
+            self._drop(node)
+            self._mark_down(node, e)
+            return None
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[bytes, bool]]:
+        """
+        Returns {key: (content, fresh)} for the keys found.
+        """
+        pairs = []
+        for node, node_keys in self._group(keys).items():
+            replies = self.pipeline(node, [('MGET', *[KEY_PREFIX + k.encode() for k in node_keys])])
+            if replies:
+                pairs.extend(zip(node_keys, replies[0]))
+        return self._found(pairs, len(keys))
+
+    def get(self, key: str) -> Tuple[bytes, bool] | None:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: Dict[str, bytes]):
+        for node, node_keys in self._group(items.keys()).items():
+            self.pipeline(node, [self._set_command(k, items[k]) for k in node_keys])
+        metrics.incr('imageopt_shared_cache_sets_total', len(items))
+
+    def set(self, key: str, value: bytes):
+        self.set_many({key: value})
+
+class AsyncSharedCache(_BaseCache):
+    """
+    asyncio client with a small pool of connections per node.
+    """
+    def __init__(self, nodes: List[str], pool_size: int = 8, **kwargs):
+        super().__init__(nodes, **kwargs)
+        self.pool_size = pool_size
+        self.idle: Dict[Tuple[asyncio.AbstractEventLoop, str], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+        # Keeps background sets referenced until they finish
+        self.pending = set()
+
+    def _idle(self, node: str) -> List:
+        # Connections belong to the loop that opened them
+        return self.idle.setdefault((asyncio.get_running_loop(), node), [])
+
+    async def _acquire(self, node: str):
+        idle = self._idle(node)
+        if idle:
+            return idle.pop()
+        (host, port) = self._address(node)
+        return await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+
+    def _release(self, node: str, connection):
+        idle = self._idle(node)
+        if len(idle) < self.pool_size:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def pipeline(self, node: str, commands: List[Tuple]) -> List:
+        connection = None
+        try:
+            connection = await self._acquire(node)
+            (reader, writer) = connection
+            writer.write(b''.join(encode_command(*c) for c in commands))
+            await writer.drain()
+
+            async def read_all():
+                return [await aread_reply(reader) for _ in commands]
+
+            replies = await asyncio.wait_for(read_all(), self.timeout)
+        except (OSError, CacheError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            if connection:
+                connection[1].close()
+            self._mark_down(node, e)
+            return None
+        except BaseException:
+            # Cancelled mid-command: replies may still be on their way, never reuse it
+            if connection:
+                connection[1].close()
+            raise
+
+        self._release(node, connection)
+        return replies
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Tuple[bytes, bool]]:
+        groups = self._group(keys)
+
+        async def get_node(node: str, node_keys: List[str]):
+            replies = await self.pipeline(node, [('MGET', *[KEY_PREFIX + k.encode() for k in node_keys])])
+            return zip(node_keys, replies[0]) if replies else []
+
+        pairs = []
+        for node_pairs in await asyncio.gather(*[get_node(n, k) for n, k in groups.items()]):
+            pairs.extend(node_pairs)
+        return self._found(pairs, len(keys))
+
+    async def get(self, key: str) -> Tuple[bytes, bool] | None:
+        return (await self.get_many([key])).get(key)
+
+    async def set_many(self, items: Dict[str, bytes]):
+        groups = self._group(items.keys())
+        await asyncio.gather(*[
+            self.pipeline(node, [self._set_command(k, items[k]) for k in node_keys])
+            for node, node_keys in groups.items()
+        ])
+        metrics.incr('imageopt_shared_cache_sets_total', len(items))
+
+    async def set(self, key: str, value: bytes):
+        await self.set_many({key: value})
+
+    def set_in_background(self, key: str, value: bytes):
+        """
+        Stores the value without holding up the response.
+        """
+        task = asyncio.create_task(self.set(key, value))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
@@ -0,0 +1,199 @@
+"""
+Stand-in for a Redis node, speaking enough of the Redis protocol (RESP) for
+the shared variant cache: PING, GET, MGET, SET (with EX/PX), DEL, DBSIZE and
+FLUSHALL. Entries are evicted least recently used once max_bytes is reached.
+
+It can run in-process for tests and local development:
+
+    server = CacheServer()
+    port = server.start()
+    ...
+    server.stop()
+
+or on its own, so every worker on the machine shares it:
+
+    python imageopt_cacheserver.py 6380
+
+With SHARED_CACHE_LOCAL=1 the services use start_local(), which runs it in
+whichever worker starts first. Use a standalone node (or Redis) in production.
+"""
+import asyncio
+from collections import OrderedDict
+import logging
+import sys
+import threading
+import time
+from typing import List, Tuple
+
+class CacheServer(object):
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, max_bytes: int = 256*1024*1024):
+        self.host = host
+        self.port = port
+        self.max_bytes = max_bytes
+
+        # key -> (value, expires at or None), least recently used first
+        self.data: OrderedDict[bytes, Tuple[bytes, float | None]] = OrderedDict()
+        self.size = 0
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    # Storage
+
+    def _get(self, key: bytes) -> bytes | None:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        (value, expires) = item
+        if expires is not None and expires <= time.monotonic():
+            self._delete(key)
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def _set(self, key: bytes, value: bytes, ttl: float | None):
+        self._delete(key)
+        self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+        self.size += len(value)
+        while self.size > self.max_bytes and self.data:
+            (oldest, _) = next(iter(self.data.items()))
+            self._delete(oldest)
+
+    def _delete(self, key: bytes) -> int:
+        item = self.data.pop(key, None)
+        if item is None:
+            return 0
+        self.size -= len(item[0])
+        return 1
+
+    # Protocol
+
+    def execute(self, args: List[bytes]) -> bytes:
+        command = args[0].upper()
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command == b'GET' and len(args) == 2:
+            return _bulk(self._get(args[1]))
+        if command == b'MGET' and len(args) >= 2:
+            values = [_bulk(self._get(key)) for key in args[1:]]
+            return b'*%d\r\n' % len(values) + b''.join(values)
+        if command == b'SET' and len(args) >= 3:
+            ttl = None
+            options = [a.upper() for a in args[3:]]
+            if b'EX' in options:
+                ttl = float(args[3 + options.index(b'EX') + 1])
+            elif b'PX' in options:
+                ttl = float(args[3 + options.index(b'PX') + 1]) / 1000
+            self._set(args[1], args[2], ttl)
+            return b'+OK\r\n'
+        if command == b'DEL' and len(args) >= 2:
+            return b':%d\r\n' % sum(self._delete(key) for key in args[1:])
+        if command == b'DBSIZE':
+            return b':%d\r\n' % len(self.data)
+        if command == b'FLUSHALL':
+            self.data.clear()
+            self.size = 0
+            return b'+OK\r\n'
+        return b'-ERR unknown command or wrong number of arguments\r\n'
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                args = await _read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                writer.write(self.execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f'cache server listening on {self.host}:{self.port}')
+        return self.server
+
+    def start(self) -> int:
+        """
+        Runs the server on a background thread and returns its port. Raises
+        OSError when the port is taken.
+        """
+        ready = threading.Event()
+        failed = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self.serve())
+            except OSError as e:
+                failed.append(e)
+                return
+            finally:
+                ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name='cache-server', daemon=True)
+        self.thread.start()
+        ready.wait()
+        if failed:
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            raise failed[0]
+        return self.port
+
+    def stop(self):
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+
+def start_local(port: int) -> str:
+    """
+    Address of the node shared by the workers of this machine, for
+    development: the first worker to start runs it in-process on `port` and
+    the others use it. If that worker exits, the next one to start takes over.
+    """
+    try:
+        CacheServer(port=port).start()
+    except OSError:
+        logging.info(f'cache server on port {port} is run by another worker')
+    return f'127.0.0.1:{port}'
+
+def _bulk(value: bytes | None) -> bytes:
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+async def _read_command(reader: asyncio.StreamReader) -> List[bytes] | None:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline command, e.g. from telnet
+        return line.split()
+
+    args = []
+    for _ in range(int(line[1:])):
+        header = await reader.readline()
+        length = int(header[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6380
+
+    async def main():
+        server = await CacheServer(host='0.0.0.0', port=port).serve()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
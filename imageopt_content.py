@@ -0,0 +1,121 @@
+"""
+Content addressing: the same asset is often served under many URLs, so
+variants are keyed by a hash of the source bytes (ImageOpt.variant_key())
+rather than by URL. The hash is computed by the source loaders while the bytes
+arrive (common.content_hasher()).
+
+ContentIndex maps each URL to the hash of what it served last. With it, a
+repeat request finds its variant in the spool or the shared cache without
+contacting the origin; a first request for a URL is fetched, hashed, and still
+reuses the variant rendered for another URL with the same bytes. Metadata read
+from a source (its dimensions) is kept per hash too.
+
+A mapping is trusted for CONTENT_INDEX_TTL seconds, after that the URL is
+fetched again to catch changes (and kept STALE_IF_ERROR seconds longer for
+when the origin is unavailable). Mappings are shared between workers through
+the shared cache when there is one.
+"""
+import hashlib
+import time
+from typing import Dict, Tuple
+
+from common import CONTENT_INDEX_MAX, CONTENT_INDEX_TTL, STALE_IF_ERROR
+import metrics
+
+def index_key(url: str) -> str:
+    """
+    Shared cache key of a URL's mapping, apart from the variant keys.
+    """
+    return 'url:' + hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+
+class ContentIndex(object):
+    def __init__(self, shared_cache=None, ttl: float = CONTENT_INDEX_TTL, max_entries: int = CONTENT_INDEX_MAX):
+        # SharedCache or AsyncSharedCache, lookup()/record() or alookup()/arecord() respectively
+        self.shared_cache = shared_cache
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # url -> (content hash, recorded at), oldest first
+        self.urls: Dict[str, Tuple[str, float]] = {}
+        # content hash -> (width, height)
+        self.dimensions: Dict[str, Tuple[int, int]] = {}
+
+    def _valid(self, recorded: float, stale: bool) -> bool:
+        ttl = self.ttl + STALE_IF_ERROR if stale else self.ttl
+        return time.time() - recorded < ttl
+
+    def _local(self, url: str, stale: bool) -> str | None:
+        entry = self.urls.get(url)
+        if entry and self._valid(entry[1], stale):
+            metrics.incr('imageopt_content_index_hits_total', source='local')
+            return entry[0]
+        return None
+
+    def _store(self, url: str, content_hash: str, recorded: float):
+        self.urls.pop(url, None)
+        self.urls[url] = (content_hash, recorded)
+        while len(self.urls) > self.max_entries:
+            del self.urls[next(iter(self.urls))]
+
+    def _restore(self, url: str, found: Tuple[bytes, bool] | None, stale: bool) -> str | None:
+        """
+        Keeps a mapping read from the shared cache, stored as b'<hash> <recorded at>'.
+        """
+        if not found:
+            return None
+        try:
+            (content_hash, recorded) = found[0].decode().split(' ')
+            recorded = float(recorded)
+        except ValueError:
+            return None
+        if not self._valid(recorded, stale):
+            return None
+        self._store(url, content_hash, recorded)
+        metrics.incr('imageopt_content_index_hits_total', source='shared_cache')
+        return content_hash
+
+    def lookup(self, url: str, stale: bool = False) -> str | None:
+        """
+        The content hash `url` served last, if it's recent enough (or within
+        STALE_IF_ERROR with stale=True).
+        """
+        content_hash = self._local(url, stale)
+        if content_hash is None and self.shared_cache:
+            content_hash = self._restore(url, self.shared_cache.get(index_key(url)), stale)
+        return content_hash
+
+    async def alookup(self, url: str, stale: bool = False) -> str | None:
+        content_hash = self._local(url, stale)
+        if content_hash is None and self.shared_cache:
+            content_hash = self._restore(url, await self.shared_cache.get(index_key(url)), stale)
+        return content_hash
+
+    def record(self, url: str, content_hash: str):
+        """
+        Records the hash of what `url` just served.
+        """
+        now = time.time()
+        self._store(url, content_hash, now)
+        if self.shared_cache:
+            self.shared_cache.set(index_key(url), f'{content_hash} {now}'.encode())
+
+    def arecord(self, url: str, content_hash: str):
+        now = time.time()
+        self._store(url, content_hash, now)
+        if self.shared_cache:
+            self.shared_cache.set_in_background(index_key(url), f'{content_hash} {now}'.encode())
+
+    def restore_metadata(self, opt):
+        """
+        Gives a freshly fetched ImageOpt what is already known about its content.
+        """
+        dimensions = self.dimensions.get(opt.state.get('content_hash'))
+        if dimensions and 'dimensions' not in opt.state:
+            opt.state['dimensions'] = dimensions
+
+    def save_metadata(self, opt):
+        content_hash = opt.state.get('content_hash')
+        if content_hash and 'dimensions' in opt.state:
+            self.dimensions.pop(content_hash, None)
+            self.dimensions[content_hash] = opt.state['dimensions']
+            while len(self.dimensions) > self.max_entries:
+                del self.dimensions[next(iter(self.dimensions))]
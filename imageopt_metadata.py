@@ -0,0 +1,156 @@
+"""
+Lossless metadata stripping on the encoded bytes, for images that are passed
+through without being decoded. Pixel data is never touched: only metadata
+segments/chunks are dropped. EXIF is kept when it carries an orientation, and
+colour information (ICC profiles, Adobe/sRGB/gamma chunks) is always kept.
+
+read_dimensions() gets the image size from the same headers, so sizing a
+source doesn't need an engine.
+"""
+from typing import BinaryIO, Tuple
+
+from common import SNIFF_BYTES, ImageFormat, sniff_format
+
+# PNG chunks that only hold text, timestamps or EXIF
+PNG_METADATA_CHUNKS = (b'tEXt', b'zTXt', b'iTXt', b'tIME', b'eXIf')
+
+def exif_orientation(tiff: bytes) -> int | None:
+    """
+    Reads the orientation tag (0x0112) from IFD0 of a TIFF-structured EXIF blob.
+    """
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return None
+    order = 'little' if tiff[:2] == b'II' else 'big'
+    ifd = int.from_bytes(tiff[4:8], order)
+    if ifd + 2 > len(tiff):
+        return None
+
+    count = int.from_bytes(tiff[ifd:ifd + 2], order)
+    for i in range(count):
+        entry = ifd + 2 + i * 12
+        if entry + 12 > len(tiff):
+            return None
+        if int.from_bytes(tiff[entry:entry + 2], order) == 0x0112:
+            return int.from_bytes(tiff[entry + 8:entry + 10], order)
+    return None
+
+def _needs_exif(exif: bytes) -> bool:
+    orientation = exif_orientation(exif)
+    return orientation is not None and orientation != 1
+
+def strip_jpeg(data: bytes) -> bytes:
+    if not data.startswith(b'\xff\xd8'):
+        return data
+
+    kept = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return data
+        marker = data[pos + 1]
+        if marker == 0xDA:
+            # Start of scan, the rest is entropy coded data
+            kept.append(data[pos:])
+            return b''.join(kept)
+
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        segment = data[pos:pos + 2 + length]
+        payload = segment[4:]
+
+        drop = False
+        if marker == 0xFE or 0xE3 <= marker <= 0xED or marker == 0xEF:
+            # COM and application segments other than JFIF, ICC and Adobe
+            drop = True
+        elif marker == 0xE1:
+            # EXIF or XMP, EXIF stays if the image relies on its orientation
+            drop = not (payload.startswith(b'Exif\x00\x00') and _needs_exif(payload[6:]))
+
+        if not drop:
+            kept.append(segment)
+        pos += 2 + length
+
+    return data
+
+def strip_png(data: bytes) -> bytes:
+    if not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return data
+
+    kept = [data[:8]]
+    pos = 8
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunk_type = data[pos + 4:pos + 8]
+        end = pos + 12 + length
+        if chunk_type not in PNG_METADATA_CHUNKS or (chunk_type == b'eXIf' and _needs_exif(data[pos + 8:pos + 8 + length])):
+            kept.append(data[pos:end])
+        pos = end
+
+    return b''.join(kept)
+
+def strip_metadata(data: bytes, fmt: ImageFormat) -> bytes:
+    if fmt == ImageFormat.JPEG:
+        return strip_jpeg(data)
+    if fmt == ImageFormat.PNG:
+        return strip_png(data)
+    return data
+
+# JPEG start of frame markers, the ones holding the image size
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def _jpeg_dimensions(f: BinaryIO) -> Tuple[int, int] | None:
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if byte != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            # Fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # No payload
+            continue
+        if marker == 0xDA:
+            return None
+
+        length = int.from_bytes(f.read(2), 'big')
+        if length < 2:
+            return None
+        if marker in JPEG_SOF_MARKERS:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            return int.from_bytes(sof[3:5], 'big'), int.from_bytes(sof[1:3], 'big')
+        f.seek(length - 2, 1)
+
+def _webp_dimensions(head: bytes) -> Tuple[int, int] | None:
+    chunk = head[12:16]
+    if chunk == b'VP8X' and len(head) >= 30:
+        # Canvas size, also for animations
+        return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+    if chunk == b'VP8L' and len(head) >= 25:
+        bits = int.from_bytes(head[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8 ' and len(head) >= 30:
+        return int.from_bytes(head[26:28], 'little') & 0x3FFF, int.from_bytes(head[28:30], 'little') & 0x3FFF
+    return None
+
+def read_dimensions(f: BinaryIO) -> Tuple[int, int] | None:
+    """
+    Width and height from the header of an image file, None if it can't be
+    read. Animations give their canvas size.
+    """
+    head = f.read(max(SNIFF_BYTES, 30))
+    fmt = sniff_format(head)
+    if fmt == ImageFormat.JPEG:
+        return _jpeg_dimensions(f)
+    if fmt == ImageFormat.PNG and head[12:16] == b'IHDR' and len(head) >= 24:
+        return int.from_bytes(head[16:20], 'big'), int.from_bytes(head[20:24], 'big')
+    if fmt == ImageFormat.GIF and len(head) >= 10:
+        return int.from_bytes(head[6:8], 'little'), int.from_bytes(head[8:10], 'little')
+    if fmt == ImageFormat.WEBP:
+        return _webp_dimensions(head)
+    return None
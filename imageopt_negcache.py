@@ -0,0 +1,83 @@
+"""
+Negative cache for sources that failed: missing on the origin, too large, or
+not decodable. Repeat requests for them are answered with the cached status
+(404/413/415) without fetching or decoding anything, until the entry expires.
+
+Entries are per source URL rather than per variant, since the failure doesn't
+depend on the options. A source that only one engine fails to decode is
+cached for that engine, the others may still serve it. Errors that may be
+transient (origin 5xx, timeouts) or aren't about the source (a missing
+library, out of memory) aren't cached.
+"""
+import time
+from typing import Dict, Tuple
+
+from common import (
+    NEGATIVE_CACHE_MAX,
+    NEGATIVE_TTL_NOT_FOUND,
+    NEGATIVE_TTL_TOO_LARGE,
+    NEGATIVE_TTL_UNSUPPORTED
+)
+from imageopt_pipeline import UnsupportedImageError
+import metrics
+
+# Checked in order, UnsupportedImageError is a ValueError but the others aren't
+ERROR_STATUSES = (
+    (FileNotFoundError, 404, NEGATIVE_TTL_NOT_FOUND),
+    (BufferError, 413, NEGATIVE_TTL_TOO_LARGE),
+    (UnsupportedImageError, 415, NEGATIVE_TTL_UNSUPPORTED),
+)
+
+def error_status(e: Exception) -> Tuple[int, float] | None:
+    """
+    Returns (HTTP status, TTL) for the errors that are cached.
+    """
+    for (cls, status, ttl) in ERROR_STATUSES:
+        if isinstance(e, cls):
+            return status, ttl
+    return None
+
+class NegativeCache(object):
+    def __init__(self, max_entries: int = NEGATIVE_CACHE_MAX):
+        self.max_entries = max_entries
+        # (url, engine or None) -> (status, message, expires at), oldest first
+        self.entries: Dict[Tuple[str, str | None], Tuple[int, str, float]] = {}
+
+    def _get(self, key: Tuple[str, str | None]) -> Tuple[int, str] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (status, message, expires) = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        return status, message
+
+    def lookup(self, url: str, engine: str | None = None) -> Tuple[int, str] | None:
+        """
+        The cached failure of the source, or of `engine` on it.
+        """
+        found = self._get((url, None))
+        if found is None and engine is not None:
+            found = self._get((url, engine))
+        if found is not None:
+            metrics.incr('imageopt_negative_cache_hits_total', status=found[0])
+        return found
+
+    def record(self, url: str, e: Exception) -> int | None:
+        """
+        Caches the failure if it's one of ERROR_STATUSES and returns its status.
+        An UnsupportedImageError naming an engine is cached for that engine only.
+        """
+        found = error_status(e)
+        if found is None:
+            return None
+        (status, ttl) = found
+        if ttl > 0:
+            key = (url, getattr(e, 'engine', None))
+            self.entries.pop(key, None)
+            self.entries[key] = (status, str(e), time.monotonic() + ttl)
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+            metrics.incr('imageopt_negative_cache_stores_total', status=status)
+        return status
@@ -0,0 +1,223 @@
+"""
+Protects the origin, and the workers, when the origin slows down or fails.
+
+Every origin (scheme, host and port) gets an OriginGuard with:
+- a concurrency limiter: at most ORIGIN_MAX_CONCURRENCY fetches in flight, a
+  fetch that can't get a slot within ORIGIN_QUEUE_TIMEOUT is rejected
+- a circuit breaker over the fetches of the last CIRCUIT_WINDOW seconds: it
+  opens when the share of failed or slow fetches reaches its threshold,
+  rejects fetches for CIRCUIT_OPEN_SECONDS, then lets a single trial fetch
+  through (half-open) which closes it again or reopens it
+
+Rejected fetches raise OriginUnavailableError, which the services answer with
+a stale cached variant when they have one and 503 otherwise.
+
+Not found, oversize and undecodable sources are answers from a healthy origin
+and count as successful fetches.
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import logging
+import threading
+import time
+from typing import Dict
+import urllib3.util
+
+from common import (
+    CIRCUIT_ERROR_RATE,
+    CIRCUIT_MIN_REQUESTS,
+    CIRCUIT_OPEN_SECONDS,
+    CIRCUIT_SLOW_RATE,
+    CIRCUIT_SLOW_SECONDS,
+    CIRCUIT_WINDOW,
+    ORIGIN_MAX_CONCURRENCY,
+    ORIGIN_QUEUE_TIMEOUT
+)
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Exceptions raised by a fetch whose origin did answer properly
+_ANSWERED = (FileNotFoundError, BufferError, ValueError)
+
+class OriginUnavailableError(Exception):
+    """
+    The fetch wasn't attempted: the circuit is open or no slot was free in time.
+    """
+
+class CircuitBreaker(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_running = False
+        # (time, failed, slow) of the recent fetches
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Whether a fetch may go to the origin now. Moves open to half-open when
+        CIRCUIT_OPEN_SECONDS have passed, and lets one trial fetch through.
+        """
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= CIRCUIT_OPEN_SECONDS:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record(self, failed: bool, seconds: float):
+        now = time.monotonic()
+        slow = seconds >= CIRCUIT_SLOW_SECONDS
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.trial_running = False
+                if failed or slow:
+                    self._open(now, 'trial fetch failed')
+                else:
+                    logging.info(f'origin {self.name} recovered, closing circuit')
+                    self.state = CLOSED
+                    self.window.clear()
+                return
+
+            self.window.append((now, failed, slow))
+            while self.window and now - self.window[0][0] > CIRCUIT_WINDOW:
+                self.window.popleft()
+            if self.state != CLOSED or len(self.window) < CIRCUIT_MIN_REQUESTS:
+                return
+
+            error_rate = sum(1 for (_, f, _) in self.window if f) / len(self.window)
+            slow_rate = sum(1 for (_, _, s) in self.window if s) / len(self.window)
+            if error_rate >= CIRCUIT_ERROR_RATE:
+                self._open(now, f'{error_rate:.0%} of fetches failed')
+            elif slow_rate >= CIRCUIT_SLOW_RATE:
+                self._open(now, f'{slow_rate:.0%} of fetches took over {CIRCUIT_SLOW_SECONDS}s')
+
+    def _open(self, now: float, reason: str):
+        logging.warning(f'origin {self.name}: {reason}, opening circuit for {CIRCUIT_OPEN_SECONDS}s')
+        self.state = OPEN
+        self.opened_at = now
+        self.window.clear()
+        metrics.incr('imageopt_origin_circuit_opens_total', origin=self.name)
+
+class OriginGuard(object):
+    def __init__(self, name: str, max_concurrency: int = ORIGIN_MAX_CONCURRENCY,
+                 queue_timeout: float = ORIGIN_QUEUE_TIMEOUT):
+        self.name = name
+        self.queue_timeout = queue_timeout
+        self.breaker = CircuitBreaker(name)
+        # Each process uses one of them, depending on the front end
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.asemaphore = asyncio.Semaphore(max_concurrency)
+        self.inflight = 0
+        self.queued = 0
+
+    def _reject(self, reason: str, message: str):
+        metrics.incr('imageopt_origin_rejected_total', origin=self.name, reason=reason)
+        raise OriginUnavailableError(f'origin {self.name} {message}')
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            self._reject('circuit_open', 'is unavailable, circuit open')
+
+    def _record(self, start: float, e: BaseException | None):
+        failed = e is not None and not isinstance(e, _ANSWERED)
+        self.breaker.record(failed, time.monotonic() - start)
+
+    @contextmanager
+    def fetch(self):
+        """
+        Wraps a blocking fetch: waits for a slot, then records the outcome.
+        """
+        self._check_circuit()
+        self.queued += 1
+        acquired = self.semaphore.acquire(timeout=self.queue_timeout)
+        self.queued -= 1
+        if not acquired:
+            self._release_trial()
+            self._reject('busy', f'has no free fetch slot after {self.queue_timeout}s')
+
+        self.inflight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self._record(start, e)
+            raise
+        except BaseException:
+            # Cancelled (client gone, warm-up budget spent): nothing learnt about the origin
+            self._release_trial()
+            raise
+        else:
+            self._record(start, None)
+        finally:
+            self.inflight -= 1
+            self.semaphore.release()
+
+    @asynccontextmanager
+    async def afetch(self):
+        self._check_circuit()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.asemaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._release_trial()
+            self._reject('busy', f'has no free fetch slot after {self.queue_timeout}s')
+        except BaseException:
+            self._release_trial()
+            raise
+        finally:
+            self.queued -= 1
+
+        self.inflight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self._record(start, e)
+            raise
+        except BaseException:
+            # Cancelled (client gone, warm-up budget spent): nothing learnt about the origin
+            self._release_trial()
+            raise
+        else:
+            self._record(start, None)
+        finally:
+            self.inflight -= 1
+            self.asemaphore.release()
+
+    def _release_trial(self):
+        # A half-open trial that never reached the origin, or was cancelled, doesn't count
+        with self.breaker.lock:
+            self.breaker.trial_running = False
+
+_guards: Dict[str, OriginGuard] = {}
+
+def origin_name(url: str) -> str:
+    parsed = urllib3.util.parse_url(url)
+    return f'{parsed.scheme}://{parsed.netloc}'
+
+def get_guard(url: str) -> OriginGuard:
+    name = origin_name(url)
+    if name not in _guards:
+        _guards[name] = OriginGuard(name)
+    return _guards[name]
+
+_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+metrics.register_gauge('imageopt_origin_circuit_state', lambda: {
+    (('origin', name),): _STATE_VALUES[guard.breaker.state] for name, guard in _guards.items()
+})
+metrics.register_gauge('imageopt_origin_inflight', lambda: {
+    (('origin', name),): guard.inflight for name, guard in _guards.items()
+})
+metrics.register_gauge('imageopt_origin_queued', lambda: {
+    (('origin', name),): guard.queued for name, guard in _guards.items()
+})
@@ -0,0 +1,969 @@
+"""
+Shared transform pipeline used by both the sync and async front ends.
+
+A request is handled by three pluggable pieces:
+- a source loader that holds the fetched image (in memory, in a temp file, or
+  streamed chunk by chunk into a temp file)
+- an engine that decodes and transforms the image (wand or pyvips)
+- an encoder, looked up by (engine, output format), that produces the bytes
+
+With engine='fastest' the engine is picked after the source is fetched, using
+the latency table in imageopt_routing.py, and a failing engine falls back to
+the others.
+
+New pieces are added with the register_* decorators below and picked by name,
+either per request or through the config in common.py.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from typing import AsyncIterable, Callable, Dict, Iterable, List, Tuple
+import urllib.parse
+
+from common import (
+    DEFAULT_ENGINE,
+    DEFAULT_LOADER,
+    DEFAULT_MAX_CONTENT_LENGTH,
+    ENGINE_WEIGHTS,
+    FORMAT_ENGINES,
+    FRAME_BATCH,
+    FRAME_WORKERS,
+    MAX_FRAMES,
+    MULTIPAGE_FORMATS,
+    OPT_PROFILE,
+    PASSTHROUGH,
+    PASSTHROUGH_HEADER_BYTES,
+    PASSTHROUGH_QUALITY_SLACK,
+    PROFILE_SAMPLE_RATE,
+    ROUTING_TABLE,
+    SNIFF_BYTES,
+    ImageFormat,
+    content_hasher,
+    estimate_jpeg_quality,
+    format_from_filename,
+    lazy_import,
+    parse_mapping,
+    sniff_format
+)
+from imageopt_aio import get_io_backend
+from imageopt_metadata import read_dimensions, strip_metadata
+from imageopt_routing import LatencyTable
+from imageopt_scheduler import tenant_from_path
+import metrics
+
+# The engine libraries load on first use, so e.g. a libvips-only worker never
+# maps ImageMagick (budgets are checked by imageopt-importtime.py)
+pyvips = lazy_import('pyvips')
+wand_color = lazy_import('wand.color')
+wand_exceptions = lazy_import('wand.exceptions')
+wand_image = lazy_import('wand.image')
+
+ENGINES: Dict[str, 'Engine'] = {}
+LOADERS: Dict[str, type] = {}
+ENCODERS: Dict[Tuple[str, ImageFormat], Callable] = {}
+
+# Encoder settings per optimisation profile, picked with ImageOpt.profile()
+PROFILES = {
+    # Encoder defaults, the original behaviour
+    'none': {},
+    # Same pixels, smaller files: orientation applied and colours converted to
+    # sRGB so metadata and ICC profiles can be stripped, optimised Huffman
+    # tables with progressive JPEG, max PNG compression with adaptive filters
+    'web': {
+        'strip': True,
+        'srgb': True,
+        'optimize_coding': True,
+        'progressive': True,
+        'png_compression': 9,
+        'png_filter': 'all'
+    },
+    # 'web' plus lossy palette quantisation for PNG
+    'web-lossy': {
+        'strip': True,
+        'srgb': True,
+        'optimize_coding': True,
+        'progressive': True,
+        'png_compression': 9,
+        'png_filter': 'all',
+        'palette': True,
+        'palette_quality': 80
+    }
+}
+
+# How resize(width, height) fits the image into the box, picked with ImageOpt.fit()
+# - inside: scaled to fit within the box (the default, also used without a height)
+# - outside: scaled to cover the box, keeping the aspect ratio
+# - cover: scaled to cover the box and cropped to its exact size
+# - contain: scaled to fit within the box and padded to its exact size
+# - fill: stretched to the exact size
+FIT_MODES = ('inside', 'outside', 'cover', 'contain', 'fill')
+# Which part of the image fit='cover' keeps
+CROP_MODES = ('centre', 'attention', 'entropy')
+
+def get_fit(options: dict) -> str:
+    (_, height) = options['resize']
+    return options.get('fit', 'inside') if height > 0 else 'inside'
+
+def get_profile(options: dict) -> dict:
+    return PROFILES[options.get('profile', 'none')]
+
+def register_engine(cls):
+    ENGINES[cls.name] = cls()
+    return cls
+
+def register_loader(name: str):
+    def wrap(cls):
+        LOADERS[name] = cls
+        return cls
+    return wrap
+
+def register_encoder(engine: str, *formats: ImageFormat):
+    def wrap(fn):
+        for fmt in formats:
+            ENCODERS[(engine, fmt)] = fn
+        return fn
+    return wrap
+
+def get_engine(name: str) -> 'Engine':
+    if name not in ENGINES:
+        raise InvalidOptionError(f"{name} is not a registered engine")
+    return ENGINES[name]
+
+def get_loader(name: str):
+    if name not in LOADERS:
+        raise InvalidOptionError(f"{name} is not a registered loader")
+    return LOADERS[name]
+
+latency_table = LatencyTable.from_file(ROUTING_TABLE)
+
+_format_engines = parse_mapping(FORMAT_ENGINES)
+_engine_weights = parse_mapping(ENGINE_WEIGHTS)
+
+def select_engine(informat: ImageFormat | None) -> str:
+    """
+    Picks an engine when the caller didn't ask for one. Formats pinned in
+    FORMAT_ENGINES go to their engine, everything else is split between the
+    engines in ENGINE_WEIGHTS (useful for A/B tests).
+    """
+    pinned = _format_engines.get(informat.value) if informat else None
+    if pinned in ENGINES:
+        return pinned
+
+    names = [name for name in _engine_weights.keys() if name in ENGINES]
+    if not names:
+        return 'vips'
+    if len(names) == 1:
+        return names[0]
+    return random.choices(names, weights=[_engine_weights[n] for n in names])[0]
+
+def configured_engines() -> List[str]:
+    """
+    The engines DEFAULT_ENGINE can send requests to, i.e. the ones a worker
+    should load at boot. Routes pinned to another engine load it on first use.
+    """
+    if DEFAULT_ENGINE == 'fastest':
+        return list(ENGINES.keys())
+    if DEFAULT_ENGINE == 'auto':
+        names = set(_engine_weights.keys()) | set(_format_engines.values())
+        return [name for name in ENGINES.keys() if name in names] or ['vips']
+    return [DEFAULT_ENGINE]
+
+def probe_dimensions(src: bytes | str) -> Tuple[int, int]:
+    """
+    Reads width and height from the image header only, without decoding pixels
+    or loading an engine library.
+    """
+    if isinstance(src, str):
+        with open(src, 'rb') as f:
+            dimensions = read_dimensions(f)
+    else:
+        dimensions = read_dimensions(io.BytesIO(src))
+    if dimensions is None:
+        raise UnsupportedImageError("cannot read the image size from the header")
+    return dimensions
+
+class UnsupportedImageError(ValueError):
+    """
+    The source isn't an image the engines can decode. `engine` names the
+    engine that failed when the others may still manage.
+    """
+    def __init__(self, message: str, engine: str | None = None):
+        super().__init__(message)
+        self.engine = engine
+
+class InvalidOptionError(ValueError):
+    """
+    A requested option (engine, loader, ...) doesn't exist, answered with 400.
+    """
+
+class OriginError(Exception):
+    """
+    The origin answered with an error other than not found, or didn't answer
+    at all (no `status` then, `timeout` tells whether it was too slow).
+    """
+    def __init__(self, url: str, status: int | None, reason: str | None = None, timeout: bool = False):
+        super().__init__(f'{url}: {reason or f"origin returned {status}"}')
+        self.status = status
+        self.timeout = timeout
+
+    def gateway_status(self) -> int:
+        return 504 if self.timeout else 502
+
+    def stale_ok(self) -> bool:
+        """
+        Whether a stale variant may be served instead: the origin failed, rather
+        than refused the request.
+        """
+        return self.status is None or self.status >= 500
+
+def check_origin_status(url: str, status: int):
+    if status in (404, 410):
+        raise FileNotFoundError(url)
+    if status != 200:
+        raise OriginError(url, status)
+
+def check_length(length: int):
+    if length > DEFAULT_MAX_CONTENT_LENGTH:
+        raise BufferError(f"Content length cannot be more than {DEFAULT_MAX_CONTENT_LENGTH}mb")
+
+def limit_chunks(chunks: Iterable[bytes]) -> Iterable[bytes]:
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        check_length(total)
+        yield chunk
+
+async def alimit_chunks(chunks: AsyncIterable[bytes]) -> AsyncIterable[bytes]:
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        check_length(total)
+        yield chunk
+
+# Source loaders
+
+@register_loader('memory')
+class MemorySource(object):
+    """
+    Keeps the fetched image in memory, no temp files.
+    """
+    streaming = False
+
+    def __init__(self):
+        self.buffer = None
+        self.path = None
+        # First bytes of the image, used to sniff its format
+        self.head = b''
+        # Hash of the image bytes, updated as they arrive
+        self.hasher = content_hasher()
+
+    def put(self, content: bytes):
+        self.buffer = content
+        self.head = content[:SNIFF_BYTES]
+        self.hasher.update(content)
+
+    async def aput(self, content: bytes):
+        self.put(content)
+
+    def read(self) -> bytes:
+        return self.buffer
+
+    def read_header(self, size: int) -> bytes:
+        # The whole buffer is cheaper than slicing a copy of it
+        return self.buffer
+
+    async def aread(self) -> bytes:
+        return self.buffer
+
+    def release(self):
+        self.buffer = None
+
+    async def arelease(self):
+        self.release()
+
+    def content_hash(self) -> str:
+        return self.hasher.hexdigest()
+
+@register_loader('tempfile')
+class TempFileSource(MemorySource):
+    """
+    Writes the fetched image to a temp file (the original implementation).
+    """
+    def put(self, content: bytes):
+        self.head = content[:SNIFF_BYTES]
+        self.hasher.update(content)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(content)
+            self.path = f.name
+
+    async def aput(self, content: bytes):
+        self.head = content[:SNIFF_BYTES]
+        self.hasher.update(content)
+        self.path = await get_io_backend().write_temp(content)
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def read_header(self, size: int) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read(size)
+
+    async def aread(self) -> bytes:
+        return await get_io_backend().read(self.path)
+
+    def release(self):
+        if self.path and os.path.isfile(self.path):
+            os.unlink(self.path)
+            logging.debug(f'deleted temp file: {self.path}')
+        self.path = None
+
+    async def arelease(self):
+        if self.path and await get_io_backend().remove(self.path):
+            logging.debug(f'deleted temp file: {self.path}')
+        self.path = None
+
+@register_loader('stream')
+class StreamSource(TempFileSource):
+    """
+    Writes the origin response to a temp file as it arrives, so the whole image
+    never has to sit in memory before the engine opens it.
+    """
+    streaming = True
+
+    def _consume(self, chunk: bytes):
+        self.hasher.update(chunk)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+
+    def put_stream(self, chunks: Iterable[bytes]):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            self.path = f.name
+            for chunk in limit_chunks(chunks):
+                self._consume(chunk)
+                f.write(chunk)
+
+    async def aput_stream(self, chunks: AsyncIterable[bytes]):
+        # The writer deletes its file if the stream fails
+        async with get_io_backend().temp_writer() as f:
+            async for chunk in alimit_chunks(chunks):
+                self._consume(chunk)
+                await f.write(chunk)
+        self.path = f.path
+
+# Engines
+
+class Engine(object):
+    name = None
+    # Whether the engine can open a source straight from its path
+    accepts_path = False
+
+    def decode(self, src: bytes | str, options: dict):
+        raise NotImplementedError
+
+    def decode_errors(self) -> Tuple[type, ...]:
+        """
+        Exceptions of the library meaning it can't read the source. Only looked
+        up after a failure, so it doesn't import the library.
+        """
+        return ()
+
+    def prepare(self, img, profile: dict):
+        """
+        Applies the pixel side of a profile (orientation, colour space) before encoding.
+        """
+        return img
+
+    def process(self, src: bytes | str, options: dict, outformat: ImageFormat) -> bytes:
+        img = self.decode(src, options)
+        encoder = ENCODERS.get((self.name, outformat))
+        if encoder is None:
+            raise ValueError(f"{self.name} has no encoder for {outformat.value}")
+
+        profile_name = options.get('profile', 'none')
+        if profile_name == 'none':
+            return encoder(img, options, outformat)
+
+        buffer = encoder(self.prepare(img, PROFILES[profile_name]), options, outformat)
+
+        # Re-encode a sample without the profile to report what it saves
+        if random.random() < PROFILE_SAMPLE_RATE:
+            baseline = encoder(self.decode(src, options), {**options, 'profile': 'none'}, outformat)
+            metrics.incr('imageopt_profile_samples_total', profile=profile_name)
+            metrics.incr('imageopt_profile_bytes_saved_total', len(baseline) - len(buffer), profile=profile_name)
+        return buffer
+
+@register_engine
+class WandEngine(Engine):
+    """
+    ImageMagick through wand.
+    """
+    name = 'wand'
+
+    def decode(self, src: bytes, options: dict):
+        if options.get('multipage') and self.frames(src) > MAX_FRAMES:
+            raise BufferError(f"Animations cannot have more than {MAX_FRAMES} frames")
+
+        img = wand_image.Image(blob=src)
+        if 'resize' in options.keys():
+            if len(img.sequence) > 1:
+                # Frames of animations are often stored as deltas, expand them before resizing
+                img.coalesce()
+                for i in range(len(img.sequence)):
+                    # A frame is a copy, written back to the container when its context exits
+                    with img.sequence[i] as frame:
+                        self.resize(frame, options)
+                img.optimize_layers()
+            else:
+                self.resize(img, options)
+        return img
+
+    def decode_errors(self) -> Tuple[type, ...]:
+        # Not ResourceLimitError and the like, those don't say anything about the source
+        return (wand_exceptions.CorruptImageError, wand_exceptions.CorruptImageFatalError,
+                wand_exceptions.MissingDelegateError, wand_exceptions.BlobError, wand_exceptions.CoderError)
+
+    def frames(self, src: bytes) -> int:
+        """
+        Number of frames, read from the headers without decoding any pixels.
+        """
+        with wand_image.Image.ping(blob=src) as header:
+            return len(header.sequence)
+
+    def resize(self, img, options: dict):
+        """
+        ImageMagick has no interest-point analysis, so every crop mode crops the centre.
+        """
+        (width, height) = options['resize']
+        fit = get_fit(options)
+        if height <= 0:
+            val = f'{width}'
+        elif fit == 'fill':
+            val = f'{width}x{height}!'
+        elif fit in ('outside', 'cover'):
+            val = f'{width}x{height}^'
+        else:
+            val = f'{width}x{height}'
+        img.transform(resize=val)
+
+        if fit == 'cover':
+            img.crop(width=width, height=height, gravity='center')
+        elif fit == 'contain':
+            img.background_color = wand_color.Color('transparent' if img.alpha_channel else 'white')
+            img.extent(width=width, height=height, gravity='center')
+
+    def prepare(self, img, profile: dict):
+        """
+        ImageMagick's colour space conversion ignores the embedded ICC profile
+        and there is no sRGB profile to convert to, so a source with one keeps
+        its colour space and profile, and only the rest of the metadata is stripped.
+        """
+        icc = img.profiles['icc']
+        if profile.get('strip'):
+            img.auto_orient()
+        if profile.get('srgb') and icc is None:
+            img.transform_colorspace('srgb')
+        if profile.get('strip'):
+            img.strip()
+            if icc is not None:
+                img.profiles['icc'] = icc
+        return img
+
+@register_engine
+class VipsEngine(Engine):
+    """
+    libvips through pyvips.
+    """
+    name = 'vips'
+    accepts_path = True
+
+    def decode(self, src: bytes | str, options: dict):
+        # use vips_thumbnail() and vips_thumbnail_buffer() for best resize performance
+        # https://github.com/libvips/libvips/wiki/HOWTO----Image-shrinking
+        from_path = isinstance(src, str)
+        if options.get('multipage'):
+            pages = self.pages(src)
+            if pages > 1:
+                return self.decode_pages(src, options, pages)
+
+        if 'resize' in options.keys():
+            (width, height) = options['resize']
+            fit = get_fit(options)
+            thumbnail = pyvips.Image.thumbnail if from_path else pyvips.Image.thumbnail_buffer
+            # thumbnail() runs the crop's interest-point analysis on the shrink-on-load
+            # image, so smart crops cost about the same as a plain resize
+            (thumb_width, kwargs) = self._thumbnail_args(src, width, height, fit, options.get('crop', 'centre'))
+            img = thumbnail(src, thumb_width, **kwargs)
+            if fit == 'contain':
+                img = self._pad(img, width, height)
+            return img
+
+        if from_path:
+            return pyvips.Image.new_from_file(src)
+        return pyvips.Image.new_from_buffer(src, '')
+
+    def decode_errors(self) -> Tuple[type, ...]:
+        return (pyvips.Error,)
+
+    def prepare(self, img, profile: dict):
+        # thumbnail() already applies the EXIF orientation, this covers the other
+        # paths. Animations are left alone since autorot would rotate the whole strip.
+        if profile.get('strip') and img.get_typeof('page-height') == 0:
+            img = img.autorot()
+        if profile.get('srgb') and img.get_typeof('icc-profile-data') != 0:
+            img = img.icc_transform('srgb')
+        return img
+
+    def _thumbnail_args(self, src: bytes | str, width: int, height: int, fit: str, crop: str) -> Tuple[int, dict]:
+        if height <= 0:
+            return width, {}
+        if fit == 'fill':
+            return width, {'height': height, 'size': 'force'}
+        if fit == 'cover':
+            return width, {'height': height, 'crop': crop}
+        if fit == 'outside':
+            # thumbnail() only fits inside a box, so size the box from the header
+            header = self._load(src)
+            scale = max(width / header.width, height / (header.get('page-height') if header.get_typeof('page-height') else header.height))
+            return math.ceil(header.width * scale), {'height': 10_000_000}
+        return width, {'height': height}
+
+    @staticmethod
+    def _pad(img, width: int, height: int):
+        background = [0] * img.bands if img.hasalpha() else [255] * img.bands
+        return img.gravity('centre', width, height, extend='background', background=background)
+
+    @staticmethod
+    def _per_page(img, page_height: int, fn):
+        frames = [fn(img.crop(0, top, img.width, page_height)) for top in range(0, img.height, page_height)]
+        out = pyvips.Image.arrayjoin(frames, across=1).copy()
+        out.set_type(pyvips.GValue.gint_type, 'page-height', frames[0].height)
+        return out
+
+    @staticmethod
+    def _load(src: bytes | str, **kwargs):
+        if isinstance(src, str):
+            return pyvips.Image.new_from_file(src, **kwargs)
+        return pyvips.Image.new_from_buffer(src, '', **kwargs)
+
+    def pages(self, src: bytes | str) -> int:
+        header = self._load(src)
+        if header.get_typeof('n-pages') == 0:
+            return 1
+        return header.get('n-pages')
+
+    def decode_pages(self, src: bytes | str, options: dict, pages: int):
+        """
+        Decodes and resizes the frames of an animation in batches of FRAME_BATCH
+        across FRAME_WORKERS threads (libvips releases the GIL), then joins them
+        back into one toilet-roll image. Only the resized frames are kept, so the
+        memory used grows with the output size rather than the source size.
+        """
+        if pages > MAX_FRAMES:
+            raise BufferError(f"Animations cannot have more than {MAX_FRAMES} frames")
+
+        if 'resize' not in options.keys():
+            return self._load(src, n=-1)
+
+        (width, height) = options['resize']
+        fit = get_fit(options)
+        # thumbnail() can't crop animations, cover resizes like outside and crops
+        # the centre of each frame afterwards
+        (thumb_width, kwargs) = self._thumbnail_args(src, width, height, 'outside' if fit == 'cover' else fit, None)
+
+        def resize_batch(first: int):
+            n = min(FRAME_BATCH, pages - first)
+            if isinstance(src, str):
+                img = pyvips.Image.thumbnail(f'{src}[page={first},n={n}]', thumb_width, **kwargs)
+            else:
+                img = pyvips.Image.thumbnail_buffer(src, thumb_width, option_string=f'page={first},n={n}', **kwargs)
+            # copy_memory() renders the batch here rather than lazily at encode time
+            return img.copy_memory()
+
+        with ThreadPoolExecutor(max_workers=FRAME_WORKERS) as pool:
+            batches = list(pool.map(resize_batch, range(0, pages, FRAME_BATCH)))
+
+        page_height = batches[0].get('page-height') if batches[0].get_typeof('page-height') else batches[0].height
+        img = batches[0]
+        for batch in batches[1:]:
+            img = img.join(batch, 'vertical')
+        img = img.copy()
+        img.set_type(pyvips.GValue.gint_type, 'page-height', page_height)
+
+        if fit == 'cover':
+            img = self._per_page(img, page_height, lambda frame: frame.crop(
+                (frame.width - width) // 2, (frame.height - height) // 2, width, height))
+        elif fit == 'contain':
+            img = self._per_page(img, page_height, lambda frame: self._pad(frame, width, height))
+
+        # join keeps the metadata of the first batch only
+        header = self._load(src, n=-1)
+        for field in ('delay', 'loop'):
+            if header.get_typeof(field) != 0:
+                img.set_type(header.get_typeof(field), field, header.get(field))
+        return img
+
+# Encoders
+
+@register_encoder('wand', ImageFormat.PNG, ImageFormat.JPEG, ImageFormat.WEBP, ImageFormat.GIF)
+def wand_encode(img, options: dict, outformat: ImageFormat) -> bytes:
+    profile = get_profile(options)
+    if 'quality' in options.keys() and outformat == ImageFormat.JPEG:
+        img.compression_quality = options['quality']
+    if outformat == ImageFormat.JPEG:
+        if profile.get('optimize_coding'):
+            img.options['jpeg:optimize-coding'] = 'true'
+        if profile.get('progressive'):
+            img.interlace_scheme = 'plane'
+    if outformat == ImageFormat.PNG:
+        if 'png_compression' in profile:
+            img.options['png:compression-level'] = str(profile['png_compression'])
+        if profile.get('png_filter') == 'all':
+            # adaptive filtering
+            img.options['png:compression-filter'] = '5'
+        if profile.get('palette'):
+            img.quantize(256, dither=True)
+    img.format = outformat.value
+    return img.make_blob()
+
+def _vips_keep(profile: dict) -> dict:
+    if not profile.get('strip'):
+        return {}
+    # keep replaced strip in libvips 8.15
+    if pyvips.at_least_libvips(8, 15):
+        return {'keep': 'none'}
+    return {'strip': True}
+
+@register_encoder('vips', ImageFormat.PNG)
+def vips_png(img, options: dict, outformat: ImageFormat) -> bytes:
+    profile = get_profile(options)
+    kwargs = _vips_keep(profile)
+    if 'png_compression' in profile:
+        kwargs['compression'] = profile['png_compression']
+    if 'png_filter' in profile:
+        kwargs['filter'] = profile['png_filter']
+    if profile.get('palette'):
+        kwargs['palette'] = True
+        kwargs['Q'] = profile['palette_quality']
+    return img.pngsave_buffer(**kwargs)
+
+@register_encoder('vips', ImageFormat.WEBP)
+def vips_webp(img, options: dict, outformat: ImageFormat) -> bytes:
+    return img.webpsave_buffer(**_vips_keep(get_profile(options)))
+
+@register_encoder('vips', ImageFormat.GIF)
+def vips_gif(img, options: dict, outformat: ImageFormat) -> bytes:
+    return img.gifsave_buffer(**_vips_keep(get_profile(options)))
+
+@register_encoder('vips', ImageFormat.JPEG)
+def vips_jpeg(img, options: dict, outformat: ImageFormat) -> bytes:
+    profile = get_profile(options)
+    kwargs = _vips_keep(profile)
+    if 'quality' in options.keys():
+        kwargs['Q'] = options['quality']
+    if profile.get('optimize_coding'):
+        kwargs['optimize_coding'] = True
+    if profile.get('progressive'):
+        kwargs['interlace'] = True
+    return img.jpegsave_buffer(**kwargs)
+
+class ImageOpt(object):
+    """
+    Transform options and engine/loader choice shared by ImageOptSync and
+    ImageOptAsync. Subclasses only add the I/O for fetching the image.
+
+    `engine` and `loader` name entries in ENGINES/LOADERS. Passing None uses
+    the class default, 'auto' picks an engine with select_engine() and
+    'fastest' picks one from latency_table. Both are resolved once the image
+    is loaded and its format is known.
+
+    The file extension is only a hint for the format: detect_format() sniffs
+    the magic bytes after the fetch and the output format follows from that.
+    """
+    engine = DEFAULT_ENGINE
+    loader = DEFAULT_LOADER
+
+    def __init__(self, img: str, engine: str | None = None, loader: str | None = None):
+        self.orig_img_path = img
+
+        filename = img.split('/')[-1]
+        hint = format_from_filename(filename)
+
+        engine = engine or self.engine
+        routing = engine if engine in ('auto', 'fastest') else None
+
+        # Transient state maintained while handling image
+        self.state = {
+            'filename': filename,
+            'image_checked': False,
+            'informat': hint,
+            'outformat': hint,
+            # Format conversions requested with png2webp()/gif2webp()
+            'conversions': {},
+            'engine': None if routing else get_engine(engine).name,
+            'routing': routing,
+            'loader': loader or self.loader,
+            # The services replace it with the TENANT_HEADER value when there is one
+            'tenant': tenant_from_path(urllib.parse.urlsplit(img).path)
+        }
+        self.source = get_loader(self.state['loader'])()
+
+        # Selected image options
+        self.imageoptions = {}
+        self._update_formats()
+
+    def variant_key(self) -> str:
+        """
+        Identifies the output for the source content and the selected options,
+        so every URL serving the same bytes shares its variants. The content
+        hash is known once the source is fetched, or beforehand from the
+        services' ContentIndex; without it the key falls back to the source URL.
+        The engine isn't part of it.
+        """
+        options = sorted((k, v) for k, v in self.imageoptions.items() if k != 'multipage')
+        conversions = sorted((k.value, v.value) for k, v in self.state['conversions'].items())
+        source = self.state.get('content_hash') or self.orig_img_path
+        raw = f'{source}|{options}|{conversions}'
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    def render_seconds(self) -> float:
+        """
+        Time spent fetching and transforming, i.e. what a cache hit saves.
+        """
+        return sum(end - start for (start, end) in (
+            self.state.get('request_time', (0, 0)), self.state.get('proc_time', (0, 0))))
+
+    def _update_formats(self):
+        informat = self.state['informat']
+        self.state['outformat'] = self.state['conversions'].get(informat, informat)
+        self.imageoptions['multipage'] = informat in MULTIPAGE_FORMATS
+
+    def detect_format(self):
+        """
+        Sets the source format from the magic bytes of the fetched image.
+        """
+        informat = sniff_format(self.source.head)
+        if informat is None:
+            raise UnsupportedImageError(f"{self.state['filename']} is not a supported image")
+
+        if informat != self.state['informat']:
+            logging.debug(f"{self.state['filename']} is {informat.value}, not {self.state['informat']}")
+            self.state['informat'] = informat
+            self._update_formats()
+
+    def probe(self) -> Tuple[int, int]:
+        if 'dimensions' not in self.state:
+            self.state['dimensions'] = probe_dimensions(self.source.path or self.source.read())
+        return self.state['dimensions']
+
+    def megapixels(self) -> float:
+        """
+        Estimated cost of the transform for the fair scheduler: the source
+        size in megapixels, 1 if its header can't be read.
+        """
+        try:
+            (width, height) = self.probe()
+        except UnsupportedImageError:
+            return 1.0
+        return width * height / 1e6
+
+    def can_passthrough(self) -> bool:
+        """
+        True when the source can be sent as is: it is already in the output
+        format, isn't larger than the requested size and, for JPEG, was saved at
+        no more than the requested quality (+ PASSTHROUGH_QUALITY_SLACK).
+        Only header metadata is read.
+        """
+        if not PASSTHROUGH or self.state['outformat'] != self.state['informat']:
+            return False
+
+        try:
+            (width, height) = self.probe()
+        except UnsupportedImageError:
+            return False
+
+        if 'resize' in self.imageoptions.keys():
+            (req_width, req_height) = self.imageoptions['resize']
+            if get_fit(self.imageoptions) in ('inside', 'outside'):
+                # Already fits in the box, no need to resize (the source is not scaled up)
+                if req_width < width or (req_height > 0 and req_height < height):
+                    return False
+            elif (req_width, req_height) != (width, height):
+                return False
+
+        if self.state['informat'] == ImageFormat.JPEG and 'quality' in self.imageoptions.keys():
+            quality = estimate_jpeg_quality(self.source.read_header(PASSTHROUGH_HEADER_BYTES))
+            if quality is None or quality > self.imageoptions['quality'] + PASSTHROUGH_QUALITY_SLACK:
+                return False
+
+        return True
+
+    def passthrough(self) -> bool:
+        """
+        Checks can_passthrough() and records the outcome in state and metrics.
+        """
+        self.state['passthrough'] = self.can_passthrough()
+        if self.state['passthrough']:
+            now = time.time()
+            self.state['proc_time'] = (now, now)
+            metrics.incr('imageopt_passthrough_total', format=self.state['informat'].value)
+        return self.state['passthrough']
+
+    def passthrough_bytes(self, content: bytes) -> bytes:
+        """
+        The passed through source, with metadata stripped losslessly when the
+        profile asks for it.
+        """
+        profile_name = self.imageoptions.get('profile', 'none')
+        if not PROFILES[profile_name].get('strip'):
+            return content
+
+        stripped = strip_metadata(content, self.state['informat'])
+        metrics.incr('imageopt_profile_bytes_saved_total', len(content) - len(stripped), profile=profile_name, stage='passthrough')
+        return stripped
+
+    def route(self):
+        """
+        Picks the engine for engine='auto' from the config, and for
+        engine='fastest' from the source format and size.
+        """
+        if self.state['engine'] is not None:
+            return
+
+        if self.state['routing'] == 'auto':
+            self.state['engine'] = select_engine(self.state['informat'])
+            return
+
+        try:
+            (width, height) = self.probe()
+        except UnsupportedImageError:
+            # The header is damaged, leave it to ImageMagick, which copes with more
+            self.state['engine'] = 'wand'
+            return
+
+        engine = latency_table.choose(ENGINES.keys(), self.state['informat'].value, width * height)
+        self.state['engine'] = engine or 'vips'
+
+    def _engine_input(self) -> bytes | str:
+        self.route()
+        if self.source.path and get_engine(self.state['engine']).accepts_path:
+            return self.source.path
+        return self.source.read()
+
+    def transform(self, src: bytes | str) -> bytes:
+        if self.state['routing'] != 'fastest':
+            return self._transform(get_engine(self.state['engine']), src)
+
+        # engine=fastest: fall back to the other engines when the chosen one fails
+        fmt = self.state['informat'].value
+        pixels = self.state['dimensions'][0] * self.state['dimensions'][1] if 'dimensions' in self.state else 0
+        engines = [self.state['engine']] + [e for e in ENGINES.keys() if e != self.state['engine']]
+        errors = []
+        for name in engines:
+            engine = get_engine(name)
+            if isinstance(src, str) and not engine.accepts_path:
+                src = self.source.read()
+            try:
+                buffer = self._transform(engine, src)
+            except Exception as e:
+                errors.append(e)
+                if name == engines[-1]:
+                    if all(isinstance(error, UnsupportedImageError) for error in errors):
+                        raise UnsupportedImageError(f"no engine can process {self.state['filename']}") from e
+                    raise
+                logging.warning(f'{name} failed on {self.state["filename"]}, falling back: {e}')
+                latency_table.record_failure(name, fmt, pixels)
+                continue
+
+            self.state['engine'] = name
+            (start_proc, end_proc) = self.state['proc_time']
+            if pixels:
+                latency_table.record(name, fmt, pixels, end_proc - start_proc)
+            return buffer
+
+    def _transform(self, engine: Engine, src: bytes | str) -> bytes:
+        start_proc = time.time()
+        try:
+            buffer = engine.process(src, self.imageoptions, self.state['outformat'])
+        except engine.decode_errors() as e:
+            raise UnsupportedImageError(f"{engine.name} cannot process {self.state['filename']}: {e}", engine.name) from e
+        end_proc = time.time()
+        self.state['proc_time'] = (start_proc, end_proc)
+        metrics.incr('imageopt_transform_total', engine=engine.name)
+        return buffer
+
+    def ext(self):
+        # Before the fetch this is only the extension hint
+        return self.state['outformat'].value if self.state['outformat'] else None
+
+    def resize(self, width: int, height: int):
+        self.imageoptions['resize'] = (width, height)
+
+    def _convert(self, informat: ImageFormat, outformat: ImageFormat, activate: bool):
+        if activate:
+            self.state['conversions'][informat] = outformat
+        else:
+            self.state['conversions'].pop(informat, None)
+        self._update_formats()
+
+    def png2webp(self, activate: bool):
+        self._convert(ImageFormat.PNG, ImageFormat.WEBP, activate)
+
+    def gif2webp(self, activate: bool):
+        """
+        Animated WebP is usually much smaller than the same GIF.
+        """
+        self._convert(ImageFormat.GIF, ImageFormat.WEBP, activate)
+
+    def fit(self, fit: str, crop: str = 'centre'):
+        """
+        Sets how resize() fits the image in its box (FIT_MODES) and, for
+        fit='cover', which part is kept (CROP_MODES). Needs a height.
+        """
+        if fit not in FIT_MODES:
+            raise InvalidOptionError(f"{fit} is not a fit mode")
+        if crop not in CROP_MODES:
+            raise InvalidOptionError(f"{crop} is not a crop mode")
+        self.imageoptions['fit'] = fit
+        if fit == 'cover':
+            self.imageoptions['crop'] = crop
+
+    def quality(self, quality: float):
+        # Only used by the JPEG encoders
+        self.imageoptions['quality'] = quality
+
+    def profile(self, name: str):
+        if name not in PROFILES:
+            raise InvalidOptionError(f"{name} is not an optimisation profile")
+        self.imageoptions['profile'] = name
+
+def set_optimizations(opt: ImageOpt, params):
+    """
+    Applies the service defaults plus any query params (`width`, `height`, `fit`,
+    `crop`, `profile`) to a request.
+    `params` only needs a `.get()`, so both Flask and FastAPI args work.
+    An unknown fit, crop or profile raises InvalidOptionError, answered with 400.
+    """
+    try:
+        width = int(params.get('width', 0))
+        height = int(params.get('height', 0))
+        if width > 0:
+            opt.resize(width, max(height, 0))
+    except:
+        pass
+
+    crop = params.get('crop')
+    fit = params.get('fit', 'cover' if crop else None)
+    if fit:
+        opt.fit(fit, crop or 'centre')
+
+    opt.png2webp(True)
+    opt.gif2webp(True)
+    opt.quality(80)
+    opt.profile(params.get('profile', OPT_PROFILE))
@@ -0,0 +1,101 @@
+"""
+Latency table used by the 'fastest' engine mode.
+
+Processing times are kept as seconds per source megapixel, per engine, source
+format and size bucket. The table is calibrated offline with
+`python imageopt-perftest.py calibrate` and then refreshed online from the
+proc_time of every request routed through it.
+"""
+import json
+import logging
+import os
+import random
+import time
+from typing import Iterable
+
+from common import ROUTING_ALPHA, ROUTING_EXPLORE, ROUTING_FAILURE_TTL
+
+# Upper bounds (in pixels) for each size bucket, checked in order
+SIZE_BUCKETS = [
+    ('small', 500_000),
+    ('medium', 4_000_000),
+    ('large', None)
+]
+
+def size_bucket(pixels: int) -> str:
+    for name, upper in SIZE_BUCKETS:
+        if upper is None or pixels < upper:
+            return name
+
+class LatencyTable(object):
+    def __init__(self, alpha: float = ROUTING_ALPHA, explore: float = ROUTING_EXPLORE,
+                 failure_ttl: float = ROUTING_FAILURE_TTL):
+        self.alpha = alpha
+        self.explore = explore
+        self.failure_ttl = failure_ttl
+
+        # 'engine/format/bucket' -> {'mean': seconds per megapixel, 'n': samples}
+        self.entries = {}
+        # 'engine/format/bucket' -> time until which the combination is skipped
+        self.failed = {}
+
+    @staticmethod
+    def _key(engine: str, fmt: str, pixels: int) -> str:
+        return f'{engine}/{fmt}/{size_bucket(pixels)}'
+
+    @classmethod
+    def from_file(cls, path: str) -> 'LatencyTable':
+        table = cls()
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                table.entries = json.load(f)
+            logging.info(f'loaded {len(table.entries)} routing entries from {path}')
+        return table
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+
+    def record(self, engine: str, fmt: str, pixels: int, seconds: float):
+        key = self._key(engine, fmt, pixels)
+        sample = seconds / max(pixels / 1_000_000, 0.001)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = {'mean': sample, 'n': 1}
+        else:
+            # Exponentially weighted so the table follows the live traffic
+            entry['mean'] += self.alpha * (sample - entry['mean'])
+            entry['n'] += 1
+        self.failed.pop(key, None)
+
+    def record_failure(self, engine: str, fmt: str, pixels: int):
+        self.failed[self._key(engine, fmt, pixels)] = time.monotonic() + self.failure_ttl
+
+    def is_failed(self, engine: str, fmt: str, pixels: int) -> bool:
+        until = self.failed.get(self._key(engine, fmt, pixels))
+        return until is not None and until > time.monotonic()
+
+    def estimate(self, engine: str, fmt: str, pixels: int) -> float | None:
+        entry = self.entries.get(self._key(engine, fmt, pixels))
+        if entry is None:
+            return None
+        return entry['mean'] * pixels / 1_000_000
+
+    def choose(self, engines: Iterable[str], fmt: str, pixels: int) -> str | None:
+        """
+        Returns the engine with the lowest estimated time, skipping recently
+        failed combinations. Engines without data are tried first so they get
+        calibrated, and a small share of requests explores the other engines.
+        """
+        candidates = [e for e in engines if not self.is_failed(e, fmt, pixels)]
+        if not candidates:
+            return None
+
+        unknown = [e for e in candidates if self.estimate(e, fmt, pixels) is None]
+        if unknown:
+            return unknown[0]
+
+        if len(candidates) > 1 and random.random() < self.explore:
+            return random.choice(candidates)
+
+        return min(candidates, key=lambda e: self.estimate(e, fmt, pixels))
@@ -0,0 +1,279 @@
+"""
+Fair sharing of the transform stage between tenants, so one tenant's burst of
+huge conversions doesn't queue everyone else behind it.
+
+A tenant is named by the TENANT_HEADER request header, or else by the first
+segment of the origin path (`/async/acme/photo.jpg` is tenant `acme`). Names
+other than 1-64 of [A-Za-z0-9_.-] are all tenant `other`.
+At most TENANT_MAX tenants are tracked, the least recently used idle one is
+forgotten to make room for a new one.
+
+Transforms get one of TRANSFORM_WORKERS slots, and once they're all busy the
+waiting transforms are ordered by start-time fair queueing: each one is tagged
+with its tenant's virtual time, advanced by its cost (source megapixels)
+divided by the tenant's weight (TENANT_WEIGHTS), and the lowest tag runs
+next. A tenant with twice the weight gets twice the pixels through, and a
+tenant that was idle goes ahead of a backlog instead of behind it.
+
+Per tenant quotas:
+- at most TENANT_MAX_CONCURRENCY transforms running, so a slot stays free for
+  the others
+- TENANT_MPX_RATE megapixels per second (token bucket of TENANT_MPX_BURST),
+  requests over it are rejected at once
+- a transform that waits more than TENANT_QUEUE_TIMEOUT for its turn is rejected
+Rejections raise QuotaExceededError, answered with 429.
+
+Scheduling is per process: it applies between the requests a worker handles
+concurrently (the async service, or the sync one with threaded workers).
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+import heapq
+import itertools
+import math
+import re
+import threading
+import time
+from typing import Callable, Dict, List
+
+from common import (
+    TENANT_MAX,
+    TENANT_MAX_CONCURRENCY,
+    TENANT_MPX_BURST,
+    TENANT_MPX_RATE,
+    TENANT_QUEUE_TIMEOUT,
+    TENANT_WEIGHTS,
+    TRANSFORM_WORKERS,
+    parse_mapping
+)
+import metrics
+
+DEFAULT_TENANT = 'default'
+# Shared by invalid names, and by new tenants while TENANT_MAX are all busy,
+# so a header can't create unbounded or malformed metrics
+OTHER_TENANT = 'other'
+TENANT_NAME = re.compile(r'[A-Za-z0-9_.-]{1,64}')
+
+class QuotaExceededError(Exception):
+    def __init__(self, tenant: str, reason: str, retry_after: int):
+        super().__init__(f'tenant {tenant} is over its {reason} quota, retry in {retry_after}s')
+        self.tenant = tenant
+        self.reason = reason
+        self.retry_after = retry_after
+
+def tenant_from_path(path: str) -> str:
+    """
+    The first segment of an origin path with more than one, e.g. /acme/photo.jpg.
+    """
+    segments = [s for s in path.split('/') if s]
+    return segments[0] if len(segments) > 1 else DEFAULT_TENANT
+
+class _Tenant(object):
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.running = 0
+        self.queued = 0
+        # Virtual finish time of the tenant's last transform
+        self.last_finish = 0.0
+        self.tokens = TENANT_MPX_BURST
+        self.refilled_at = time.monotonic()
+
+class _Waiter(object):
+    def __init__(self, tenant: _Tenant, cost: float, wake: Callable[[], None]):
+        self.tenant = tenant
+        self.cost = cost
+        self.wake = wake
+        self.granted = False
+        self.abandoned = False
+
+class FairScheduler(object):
+    def __init__(self, workers: int = TRANSFORM_WORKERS, max_concurrency: int = TENANT_MAX_CONCURRENCY,
+                 queue_timeout: float = TENANT_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.weights = parse_mapping(TENANT_WEIGHTS)
+        self.running = 0
+        self.virtual_time = 0.0
+        self.tenants: Dict[str, _Tenant] = {}
+        # (start tag, arrival order, waiter)
+        self.waiting: List = []
+        self.arrivals = itertools.count()
+        self.lock = threading.Lock()
+        # Runs the transforms of the async front end off the event loop
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='imageopt-transform')
+
+    def _tenant(self, name: str) -> _Tenant:
+        if not TENANT_NAME.fullmatch(name):
+            name = OTHER_TENANT
+        tenant = self.tenants.pop(name, None)
+        if tenant is None:
+            if len(self.tenants) >= TENANT_MAX and not self._evict_idle() and name not in self.weights:
+                # All TENANT_MAX tenants are busy
+                name = OTHER_TENANT
+                tenant = self.tenants.pop(name, None)
+            if tenant is None:
+                tenant = _Tenant(name, self.weights.get(name, 1.0))
+        # Least recently used first
+        self.tenants[name] = tenant
+        return tenant
+
+    def _evict_idle(self) -> bool:
+        """
+        Forgets the least recently used tenant with nothing queued or running,
+        and its metrics. Called with the lock held.
+        """
+        for tenant in self.tenants.values():
+            if tenant.running == 0 and tenant.queued == 0:
+                del self.tenants[tenant.name]
+                metrics.drop(tenant=tenant.name)
+                return True
+        return False
+
+    def _take_tokens(self, tenant: _Tenant, cost: float):
+        if TENANT_MPX_RATE <= 0:
+            return
+        now = time.monotonic()
+        tenant.tokens = min(TENANT_MPX_BURST, tenant.tokens + (now - tenant.refilled_at) * TENANT_MPX_RATE)
+        tenant.refilled_at = now
+        # An image larger than the burst goes through once the bucket is full
+        needed = min(cost, TENANT_MPX_BURST)
+        if tenant.tokens < needed:
+            self._reject(tenant, 'rate', (needed - tenant.tokens) / TENANT_MPX_RATE)
+        tenant.tokens -= cost
+
+    def _reject(self, tenant: _Tenant, reason: str, retry_after: float):
+        metrics.incr('imageopt_tenant_rejected_total', tenant=tenant.name, reason=reason)
+        raise QuotaExceededError(tenant.name, reason, max(math.ceil(retry_after), 1))
+
+    def _enqueue(self, name: str, cost: float, wake: Callable[[], None]) -> _Waiter:
+        """
+        Queues a transform and starts whatever may run now, maybe this one.
+        """
+        with self.lock:
+            tenant = self._tenant(name)
+            self._take_tokens(tenant, cost)
+            start = max(self.virtual_time, tenant.last_finish)
+            tenant.last_finish = start + cost / tenant.weight
+            tenant.queued += 1
+            waiter = _Waiter(tenant, cost, wake)
+            heapq.heappush(self.waiting, (start, next(self.arrivals), waiter))
+            self._dispatch()
+        return waiter
+
+    def _dispatch(self):
+        """
+        Grants free slots to the lowest start tags, skipping tenants at their
+        concurrency quota. Called with the lock held.
+        """
+        skipped = []
+        while self.waiting and self.running < self.workers:
+            (start, order, waiter) = heapq.heappop(self.waiting)
+            if waiter.abandoned:
+                continue
+            if waiter.tenant.running >= self.max_concurrency:
+                skipped.append((start, order, waiter))
+                continue
+            self.virtual_time = max(self.virtual_time, start)
+            self.running += 1
+            waiter.tenant.running += 1
+            waiter.tenant.queued -= 1
+            waiter.granted = True
+            waiter.wake()
+        for entry in skipped:
+            heapq.heappush(self.waiting, entry)
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """
+        Gives up on a queued transform, unless its slot was granted meanwhile.
+        """
+        with self.lock:
+            if waiter.granted:
+                return False
+            waiter.abandoned = True
+            waiter.tenant.queued -= 1
+            # It never ran, so it doesn't count against the tenant's share
+            waiter.tenant.last_finish -= waiter.cost / waiter.tenant.weight
+            return True
+
+    def _release(self, waiter: _Waiter, seconds: float):
+        # Before the tenant may go idle and be evicted with its metrics
+        metrics.incr('imageopt_tenant_transforms_total', tenant=waiter.tenant.name)
+        metrics.incr('imageopt_tenant_megapixels_total', waiter.cost, tenant=waiter.tenant.name)
+        metrics.incr('imageopt_tenant_transform_seconds_total', seconds, tenant=waiter.tenant.name)
+        with self.lock:
+            self.running -= 1
+            waiter.tenant.running -= 1
+            self._dispatch()
+
+    def _granted(self, waiter: _Waiter, queued_at: float):
+        metrics.incr('imageopt_tenant_queue_seconds_total', time.monotonic() - queued_at, tenant=waiter.tenant.name)
+
+    @contextmanager
+    def slot(self, tenant: str, cost: float):
+        """
+        Waits for the tenant's turn to run a transform of `cost` megapixels.
+        """
+        queued_at = time.monotonic()
+        event = threading.Event()
+        waiter = self._enqueue(tenant, cost, event.set)
+        if not event.wait(self.queue_timeout) and self._abandon(waiter):
+            self._reject(waiter.tenant, 'queue', self.queue_timeout)
+        self._granted(waiter, queued_at)
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(waiter, time.monotonic() - start)
+
+    @asynccontextmanager
+    async def aslot(self, tenant: str, cost: float):
+        queued_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            # Dispatch may run in an executor thread releasing its slot
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(tenant, cost, wake)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(waiter):
+                self._reject(waiter.tenant, 'queue', self.queue_timeout)
+        except asyncio.CancelledError:
+            # The client went away, give the slot back if it was granted already
+            if not self._abandon(waiter):
+                self._release(waiter, 0)
+            raise
+        self._granted(waiter, queued_at)
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(waiter, time.monotonic() - start)
+
+    async def run(self, fn: Callable, *args):
+        """
+        Runs a transform in the scheduler's threads, off the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+scheduler = FairScheduler()
+
+metrics.register_gauge('imageopt_tenant_running', lambda: {
+    (('tenant', t.name),): t.running for t in list(scheduler.tenants.values())
+})
+metrics.register_gauge('imageopt_tenant_queued', lambda: {
+    (('tenant', t.name),): t.queued for t in list(scheduler.tenants.values())
+})
+metrics.register_gauge('imageopt_tenant_weight', lambda: {
+    (('tenant', t.name),): t.weight for t in list(scheduler.tenants.values())
+})
+metrics.set_gauge('imageopt_tenant_concurrency_quota', scheduler.max_concurrency)
+metrics.set_gauge('imageopt_tenant_rate_quota_megapixels', TENANT_MPX_RATE)
@@ -0,0 +1,111 @@
+"""
+Disk spool for large outputs.
+
+Outputs of at least SPOOL_THRESHOLD bytes are written once to SPOOL_DIR, named
+after the variant key, and the services answer with the file (Flask send_file
+under gunicorn uses os.sendfile, FastAPI's FileResponse uses zero-copy sends
+where the server supports them) instead of pushing the bytes through the
+response object. The files double as a short-term cache shared by all the
+workers on the machine: they are reused for SPOOL_TTL seconds, and kept
+STALE_IF_ERROR seconds longer for when the origin is unavailable.
+"""
+import logging
+import os
+import time
+from typing import Tuple
+
+from common import SPOOL_MAX_BYTES, SPOOL_SWEEP_INTERVAL, SPOOL_TTL, STALE_IF_ERROR, ImageFormat
+from imageopt_aio import get_io_backend, write_atomic
+import metrics
+
+class Spool(object):
+    def __init__(self, directory: str, ttl: float = SPOOL_TTL, max_bytes: int = SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.last_sweep = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, f'{key}.{ext}')
+
+    def lookup(self, key: str, stale: bool = False) -> Tuple[str, str] | None:
+        """
+        Returns (path, ext) of a fresh spooled variant, or of a stale one too
+        with stale=True.
+        """
+        now = time.time()
+        ttl = self.ttl + STALE_IF_ERROR if stale else self.ttl
+        for fmt in ImageFormat:
+            path = self._path(key, fmt.value)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if now - mtime < ttl:
+                metrics.incr('imageopt_spool_hits_total')
+                return path, fmt.value
+
+        return None
+
+    async def alookup(self, key: str, stale: bool = False) -> Tuple[str, str] | None:
+        # One hop to the I/O backend for all the stat() calls
+        return await get_io_backend().run(self.lookup, key, stale)
+
+    def store(self, key: str, content: bytes, ext: str) -> str:
+        path = self._path(key, ext)
+        write_atomic(path, content)
+        metrics.incr('imageopt_spool_stores_total')
+        metrics.incr('imageopt_spool_bytes_written_total', len(content))
+        self._maybe_sweep()
+        return path
+
+    async def astore(self, key: str, content: bytes, ext: str) -> str:
+        path = self._path(key, ext)
+        await get_io_backend().write_atomic(path, content)
+        metrics.incr('imageopt_spool_stores_total')
+        metrics.incr('imageopt_spool_bytes_written_total', len(content))
+        if self._sweep_due():
+            await get_io_backend().run(self.sweep)
+        return path
+
+    def _sweep_due(self) -> bool:
+        return time.monotonic() - self.last_sweep > SPOOL_SWEEP_INTERVAL
+
+    def _maybe_sweep(self):
+        if self._sweep_due():
+            self.sweep()
+
+    def sweep(self):
+        """
+        Deletes expired files, then the oldest ones until the spool fits in max_bytes.
+        """
+        self.last_sweep = time.monotonic()
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            # Leftover partial writes are expired too
+            if now - stat.st_mtime >= self.ttl + STALE_IF_ERROR:
+                self._unlink(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._unlink(path)
+            total -= size
+
+        metrics.set_gauge('imageopt_spool_bytes', total)
+
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+            logging.debug(f'deleted spooled file: {path}')
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,227 @@
+"""
+Warm-up of a freshly started worker, so a rolling deploy doesn't show up as a
+p99 spike:
+- every engine the worker is configured for (configured_engines()) decodes
+  and encodes a tiny image in each format, which loads the library and
+  initialises its codecs; other engines stay unloaded
+- the most requested paths, recorded by the running workers in HOT_KEYS_FILE,
+  are replayed through the service, so their variants are in the spool and
+  the shared cache and the origin/cache connections are open
+
+The services run it before the worker starts serving (Flask at app load,
+FastAPI in its lifespan) and their /ready route only answers 200 afterwards.
+Replaying stops after WARMUP_BUDGET seconds, so a slow origin can't keep a
+worker from booting past its timeout.
+"""
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+from typing import Callable, List
+import zlib
+
+from common import (
+    HOT_KEYS_FILE,
+    HOT_KEYS_MAX,
+    HOT_KEYS_PRELOAD,
+    HOT_KEYS_SAVE_INTERVAL,
+    MULTIPAGE_FORMATS,
+    OPT_PROFILE,
+    WARMUP_BUDGET
+)
+from imageopt_pipeline import ENCODERS, configured_engines, get_engine
+import metrics
+
+# Header sent with replayed requests, so they aren't recorded again
+WARMUP_HEADER = 'X-Imageopt-Warmup'
+
+ready = False
+
+def sample_png(size: int = 16) -> bytes:
+    """
+    A plain RGB PNG, written by hand so no engine is needed to make it.
+    """
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    rows = b''.join(b'\x00' + bytes([200, 120, 40]) * size for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+def warm_engines(names: List[str] | None = None):
+    """
+    Encodes the sample PNG to every format the engines have an encoder for,
+    then decodes and encodes the result again to warm the decoder too.
+    """
+    names = names or configured_engines()
+    png = sample_png()
+    for (name, fmt) in ENCODERS.keys():
+        if name not in names:
+            continue
+        start = time.time()
+        try:
+            engine = get_engine(name)
+            options = {'resize': (8, 8), 'quality': 80, 'profile': OPT_PROFILE, 'multipage': False}
+            encoded = engine.process(png, options, fmt)
+            engine.process(encoded, {**options, 'multipage': fmt in MULTIPAGE_FORMATS}, fmt)
+        except Exception as e:
+            logging.warning(f'warm-up of {name}/{fmt.value} failed: {e}')
+            continue
+        metrics.incr('imageopt_warmup_encodes_total', engine=name)
+        logging.debug(f'warmed up {name}/{fmt.value} in {time.time() - start:.3f}s')
+
+class HotKeys(object):
+    """
+    Counts the requested paths (path and query string) of a worker, which
+    the services merge into HOT_KEYS_FILE every HOT_KEYS_SAVE_INTERVAL
+    seconds. Counts already in the file are halved on each merge, so old
+    favourites fade out.
+    """
+    def __init__(self, path: str = HOT_KEYS_FILE):
+        self.path = path
+        self.counts = Counter()
+        self.last_save = time.monotonic()
+
+    def record(self, request_path: str):
+        if self.path:
+            self.counts[request_path] += 1
+
+    def save_due(self) -> bool:
+        return bool(self.path) and time.monotonic() - self.last_save > HOT_KEYS_SAVE_INTERVAL
+
+    def load(self, prefix: str = '/') -> List[str]:
+        """
+        Recorded paths starting with `prefix`, most requested first. Both
+        services can share the file, each replays its own paths.
+        """
+        if not self.path or not os.path.isfile(self.path):
+            return []
+        try:
+            with open(self.path) as f:
+                counts = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f'cannot read hot keys from {self.path}: {e}')
+            return []
+        paths = [path for path in counts.keys() if path.startswith(prefix)]
+        return sorted(paths, key=counts.get, reverse=True)
+
+    def take(self) -> Counter:
+        """
+        The counts since the last save, counting starts again from zero.
+        """
+        self.last_save = time.monotonic()
+        (counts, self.counts) = (self.counts, Counter())
+        return counts
+
+    def save(self, counts: Counter | None = None):
+        """
+        Merges `counts` (by default take()) into the file. It blocks, so the
+        async service takes the counts on the event loop and saves them in
+        the I/O backend.
+        """
+        if counts is None:
+            counts = self.take()
+        merged = Counter()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    merged.update({k: v / 2 for k, v in json.load(f).items()})
+            except (OSError, ValueError):
+                pass
+        merged.update(counts)
+
+        # Write next to the file then rename, workers save concurrently
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(merged.most_common(HOT_KEYS_MAX)), f)
+        os.replace(tmp, self.path)
+
+hot_keys = HotKeys()
+
+def _out_of_budget(left: int, budget: float):
+    logging.warning(f'warm-up stopped after {budget}s, {left} hot paths not replayed')
+    metrics.incr('imageopt_warmup_skipped_total', left)
+
+def preload(replay: Callable[[str], int], prefix: str, limit: int = HOT_KEYS_PRELOAD,
+            budget: float = WARMUP_BUDGET):
+    """
+    Replays the hottest recorded paths, `replay` returns the response status.
+    Returns after `budget` seconds at most, a replay still running then
+    finishes in the background.
+    """
+    deadline = time.monotonic() + budget
+    paths = hot_keys.load(prefix)[:limit]
+    pool = ThreadPoolExecutor(1, thread_name_prefix='imageopt-warmup')
+    for (i, request_path) in enumerate(paths):
+        try:
+            status = pool.submit(replay, request_path).result(max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            _out_of_budget(len(paths) - i, budget)
+            break
+        except Exception as e:
+            logging.warning(f'warm-up request {request_path} failed: {e}')
+            continue
+        metrics.incr('imageopt_warmup_requests_total', status=status)
+    pool.shutdown(wait=False)
+
+async def asgi_get(app, request_path: str) -> int:
+    """
+    Sends a GET for `request_path` straight to an ASGI app and returns the status.
+    """
+    (path, _, query) = request_path.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': query.encode(),
+        'headers': [(WARMUP_HEADER.lower().encode(), b'1')],
+        'client': ('127.0.0.1', 0),
+        'server': ('127.0.0.1', 0),
+    }
+    status = {}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+
+    await app(scope, receive, send)
+    return status.get('code', 500)
+
+async def apreload(app, prefix: str, limit: int = HOT_KEYS_PRELOAD, budget: float = WARMUP_BUDGET):
+    """
+    preload() for an ASGI app, the paths are sent to it with asgi_get(). The
+    request running when the budget is spent is cancelled.
+    """
+    deadline = time.monotonic() + budget
+    paths = hot_keys.load(prefix)[:limit]
+    for (i, request_path) in enumerate(paths):
+        try:
+            status = await asyncio.wait_for(asgi_get(app, request_path), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            _out_of_budget(len(paths) - i, budget)
+            break
+        except Exception as e:
+            logging.warning(f'warm-up request {request_path} failed: {e}')
+            continue
+        metrics.incr('imageopt_warmup_requests_total', status=status)
+
+def mark_ready(start: float):
+    global ready
+    ready = True
+    metrics.set_gauge('imageopt_warmup_seconds', time.monotonic() - start)
+    logging.info(f'worker {os.getpid()} warmed up in {time.monotonic() - start:.2f}s')
@@ -6,7 +6,7 @@ BUCKET_DIR = os.environ.get('BUCKET_DIR', 'bucket')
 class UserRequest(HttpUser):
     host = 'http://localhost:8001'
     
-    IMAGES = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpg',  '.jpeg', '.png', '.webp'))]
+    IMAGES = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpg',  '.jpeg', '.png', '.webp', '.gif'))]
 
     WIDTHS = [1024]
 
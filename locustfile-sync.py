@@ -10,7 +10,7 @@ class UserRequest(HttpUser):
 
     WIDTHS = [1024]
 
-    IMAGES = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpg',  '.jpeg', '.png', '.webp'))]
+    IMAGES = [i for i in os.listdir(BUCKET_DIR) if i.endswith(('.jpg',  '.jpeg', '.png', '.webp', '.gif'))]
 
     @tag('sync-imagemagick')
     @task
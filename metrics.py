@@ -0,0 +1,62 @@
+"""
+Per-process counters and gauges, rendered in the Prometheus text format by
+the /metrics route of each service. With gunicorn every worker keeps its own
+values, so scrape the workers or sum the series.
+"""
+from collections import defaultdict
+from typing import Callable, Dict, Tuple
+
+_counters: Dict[Tuple[str, Tuple], float] = defaultdict(float)
+_gauges: Dict[Tuple[str, Tuple], float] = {}
+# Gauges read when rendering, e.g. a state owned by another module
+_callbacks: Dict[str, Callable[[], Dict[Tuple, float]]] = {}
+
+def _labels(labels: dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+def incr(name: str, value: float = 1, **labels):
+    _counters[(name, _labels(labels))] += value
+
+def set_gauge(name: str, value: float, **labels):
+    _gauges[(name, _labels(labels))] = value
+
+def register_gauge(name: str, fn: Callable[[], Dict[Tuple, float]]):
+    """
+    `fn` returns {labels: value}, where labels is a tuple of (key, value) pairs.
+    """
+    _callbacks[name] = fn
+
+def drop(**labels):
+    """
+    Removes every series carrying these labels, e.g. of a tenant that's gone.
+    """
+    pairs = set(labels.items())
+    for store in (_counters, _gauges):
+        for key in list(store):
+            if pairs <= set(key[1]):
+                store.pop(key, None)
+
+def get(name: str, **labels) -> float:
+    key = (name, _labels(labels))
+    return _counters.get(key, _gauges.get(key, 0))
+
+def _escape(value) -> str:
+    # As the exposition format requires for label values
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(name: str, labels: Tuple, value: float) -> str:
+    if labels:
+        label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+        return f'{name}{{{label_str}}} {value}'
+    return f'{name} {value}'
+
+def render() -> str:
+    lines = []
+    for (name, labels), value in sorted(_counters.items()):
+        lines.append(_format(name, labels, value))
+    for (name, labels), value in sorted(_gauges.items()):
+        lines.append(_format(name, labels, value))
+    for name, fn in sorted(_callbacks.items()):
+        for labels, value in sorted(fn().items()):
+            lines.append(_format(name, labels, value))
+    return '\n'.join(lines) + '\n'
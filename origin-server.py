@@ -15,6 +15,8 @@ app = FastAPI()
 async def get_image_from_cache(img: str):
     if SIMULATED_LATENCY > 0.0:
         await asyncio.sleep(SIMULATED_LATENCY)
+    if img not in image_cache:
+        return Response(status_code=404)
     ext = img.split('.')[-1]
     contenttype = 'jpeg' if ext in ['jpeg', 'jpg'] else ext
 